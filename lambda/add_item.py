@@ -1,54 +1,96 @@
-import json
-from common import format_response, INVOICE_TABLE, verify_jwt_from_event
+import uuid
+from common import (
+    format_response, INVOICE_TABLE, LINE_ITEMS_TABLE, DYNAMODB_CLIENT, api_handler,
+    TransactionCanceledException, transaction_cancel_reasons, transaction_cancel_item, to_line_item_row,
+    uses_item_collection, items_generation_condition, INVOICE_ITEMS_LAYOUT, ITEMS_LAYOUT_COLLECTION, VERSION_NAMES,
+    validate_line_item, decimal_to_float
+)
 
-def lambda_handler(event, context):
-    payload, error = verify_jwt_from_event(event)
-    if error:
-        return format_response(401, message=error)
+COLLECTION_WRITE_MAX_ATTEMPTS = 3
 
+def _append_embedded(reference_id, item):
+    """list_append onto an embedded-layout invoice; False if it isn't one."""
     try:
-        path_params = event.get("pathParameters", {}) or {}
-        reference_id = path_params.get("reference_id")
+        INVOICE_TABLE.update_item(
+            Key={"reference_id": reference_id},
+            UpdateExpression="SET #items = list_append(if_not_exists(#items, :empty), :new) ADD #version :one",
+            ConditionExpression="attribute_exists(reference_id) AND attribute_not_exists(items_layout)",
+            ExpressionAttributeNames={"#items": "items", **VERSION_NAMES},  # ITEMS is a reserved word
+            ExpressionAttributeValues={":new": [item], ":empty": [], ":one": 1},
+        )
+        return True
+    except DYNAMODB_CLIENT.exceptions.ConditionalCheckFailedException:
+        return False
 
-        if not reference_id:
-            return format_response(400, message="reference_id is required in path")
+def _put_collection(reference_id, item):
+    """
+    Put one row + bump item_count on a collection-layout invoice; False if it
+    isn't one, "conflict" if its items keep being rewritten underneath us.
+    The row goes into the header's current items generation; when a rewrite
+    switched it, the cancelled header check returns the new one to retry with.
+    """
+    generation = None
+    for _ in range(COLLECTION_WRITE_MAX_ATTEMPTS):
+        generation_expr, generation_values = items_generation_condition(generation)
+        try:
+            DYNAMODB_CLIENT.transact_write_items(TransactItems=[
+                {"Update": {
+                    "TableName": INVOICE_TABLE.name,
+                    "Key": {"reference_id": reference_id},
+                    "UpdateExpression": "ADD item_count :one, #version :one",
+                    "ConditionExpression": f"items_layout = :collection AND {generation_expr}",
+                    "ExpressionAttributeNames": VERSION_NAMES,
+                    "ExpressionAttributeValues": {":one": 1, ":collection": ITEMS_LAYOUT_COLLECTION, **generation_values},
+                    "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+                }},
+                {"Put": {
+                    "TableName": LINE_ITEMS_TABLE.name,
+                    "Item": to_line_item_row(reference_id, item, generation=generation),
+                    "ConditionExpression": "attribute_not_exists(item_key)",
+                }},
+            ])
+            return True
+        except TransactionCanceledException as e:
+            if transaction_cancel_reasons(e)[:1] != ["ConditionalCheckFailed"]:
+                raise
+            header = transaction_cancel_item(e, 0)
+            if not uses_item_collection(header):
+                return False
+            generation = header.get("items_generation")
+    return "conflict"
 
-        item = json.loads(event.get("body") or "{}")
-        required_fields = [
-            "id",
-            "particulars",
-            "project_class",
-            "account",
-            "vatable",
-            "amount"
-        ]
+def add_item(request):
+    """
+    Adds a line item to an invoice in a single conditional write, so
+    concurrent adds never overwrite each other: list_append for embedded
+    invoices, one row in the item collection for collection invoices.
+    Item ids are generated server-side.
+    """
+    reference_id = request.path_param("reference_id")
 
-        for field in required_fields:
-            if field not in item:
-                return format_response(400, message=f"Missing item field: {field}")
+    item, errors = validate_line_item(request.json())
+    if errors:
+        return format_response(400, message="Validation Error", errors=errors)
 
-        invoice = INVOICE_TABLE.get_item(Key={"reference_id": reference_id})
-        if "Item" not in invoice:
-            return format_response(404, message="Invoice not found")
+    # Server-generated id; any client-supplied id is ignored
+    item["id"] = str(uuid.uuid4())
 
-        items = invoice["Item"].get("items", [])
-        items.append(item)
+    # Try the configured layout first; the other covers invoices not yet migrated
+    attempts = (_put_collection, _append_embedded) if INVOICE_ITEMS_LAYOUT == ITEMS_LAYOUT_COLLECTION \
+        else (_append_embedded, _put_collection)
+    for attempt in attempts:
+        outcome = attempt(reference_id, item)
+        if outcome == "conflict":
+            return format_response(409, message="Invoice items changed concurrently, please retry")
+        if outcome:
+            break
+    else:
+        return format_response(404, message="Invoice not found")
 
-        INVOICE_TABLE.update_item(
-            Key={"reference_id": reference_id},
-            UpdateExpression="SET items = :items",
-            ExpressionAttributeValues={":items": items}
-        )
-
-        return format_response(
-            200,
-            message="Item added successfully",
-            data=item
-        )
+    return format_response(
+        200,
+        message="Item added successfully",
+        data=decimal_to_float(item)
+    )
 
-    except Exception as e:
-        return format_response(
-            500,
-            message="Internal Server Error",
-            errors={"exception": str(e)}
-        )
+lambda_handler = api_handler()(add_item)
@@ -0,0 +1,11 @@
+from common import build_directory_snapshot
+
+def lambda_handler(event, context):
+    """
+    Rebuilds the compact employee directory snapshot in S3. Runs on a
+    schedule as a safety net; BumpGenerationsFunction also rebuilds it right
+    after every Employees change.
+    """
+    summary = build_directory_snapshot()
+    print(f"Directory snapshot written: {summary}")
+    return summary
@@ -0,0 +1,143 @@
+import os
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from common import (
+    format_response, INVOICE_TABLE, DYNAMODB_CLIENT, get_employee,
+    condition_failure_item, invoice_version, version_condition, VERSION_NAMES,
+    api_handler, timing, map_errors, authenticate, idempotent
+)
+
+BULK_STATUS_MAX_INVOICES = int(os.getenv("BULK_STATUS_MAX_INVOICES", "100"))
+BULK_STATUS_WORKERS = int(os.getenv("BULK_STATUS_WORKERS", "16"))
+DECISIONS = ("Approved", "Rejected")
+
+def _normalize_updates(body):
+    """
+    Accepts {"status": "Approved", "reference_ids": [...], "remarks": "..."}
+    or {"updates": [{"reference_id", "status", "remarks"?, "version"?}]}.
+    Returns (updates, errors).
+    """
+    if "updates" in body:
+        updates = body["updates"]
+    else:
+        updates = [
+            {"reference_id": ref, "status": body.get("status"), "remarks": body.get("remarks")}
+            for ref in body.get("reference_ids") or []
+        ]
+    if not isinstance(updates, list) or not updates:
+        return None, {"updates": "Provide 'reference_ids' with a 'status', or an 'updates' list"}
+    if len(updates) > BULK_STATUS_MAX_INVOICES:
+        return None, {"updates": f"At most {BULK_STATUS_MAX_INVOICES} invoices per request"}
+
+    errors, seen = {}, set()
+    for idx, update in enumerate(updates):
+        if not isinstance(update, dict) or not isinstance(update.get("reference_id"), str):
+            errors[f"update_{idx}"] = "reference_id is required"
+        elif update.get("status") not in DECISIONS:
+            errors[f"update_{idx}"] = f"status must be one of {list(DECISIONS)}"
+        elif update["reference_id"] in seen:
+            errors[f"update_{idx}"] = f"Duplicate reference_id {update['reference_id']}"
+        elif update.get("version") is not None and (
+            not isinstance(update["version"], int) or isinstance(update["version"], bool)  # bool is an int subclass
+        ):
+            errors[f"update_{idx}"] = "version must be an integer"
+        else:
+            seen.add(update["reference_id"])
+    return updates, errors
+
+def transition(update, decided_by, restrict_to_approver):
+    """Pending -> Approved/Rejected for one invoice, as a single conditional write."""
+    names = {"#status": "status", **VERSION_NAMES}
+    values = {
+        ":new": update["status"],
+        ":pending": "Pending",
+        ":by": decided_by,
+        ":at": datetime.utcnow().isoformat(),
+        ":one": 1,
+    }
+    sets = ["#status = :new", "decided_by = :by", "decision_date = :at"]
+    conditions = ["attribute_exists(reference_id)", "#status = :pending"]
+    if update.get("remarks") is not None:
+        sets.append("remarks = :remarks")
+        values[":remarks"] = update["remarks"]
+    if restrict_to_approver:
+        conditions.append("approver = :by")
+    version_expr, version_values = version_condition(update.get("version"))
+    if version_expr:
+        conditions.append(version_expr)
+        values.update(version_values)
+
+    reference_id = update["reference_id"]
+    try:
+        resp = INVOICE_TABLE.update_item(
+            Key={"reference_id": reference_id},
+            UpdateExpression="SET " + ", ".join(sets) + " ADD #version :one",
+            ConditionExpression=" AND ".join(conditions),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ReturnValues="UPDATED_NEW",
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
+        )
+    except DYNAMODB_CLIENT.exceptions.ConditionalCheckFailedException as e:
+        old = condition_failure_item(e)
+        if old is None:
+            return {"reference_id": reference_id, "outcome": "not_found"}
+        if old.get("status") != "Pending":
+            return {"reference_id": reference_id, "outcome": "not_pending", "current_status": old.get("status")}
+        if restrict_to_approver and old.get("approver") != decided_by:
+            return {"reference_id": reference_id, "outcome": "forbidden"}
+        return {"reference_id": reference_id, "outcome": "version_conflict", "current_version": invoice_version(old)}
+    except Exception as e:
+        print(f"Status transition failed for {reference_id}: {e}")
+        return {"reference_id": reference_id, "outcome": "error", "error": str(e)}
+
+    return {
+        "reference_id": reference_id,
+        "outcome": "updated",
+        "status": update["status"],
+        "version": invoice_version(resp.get("Attributes", {})),
+    }
+
+def update_statuses(request):
+    """
+    Approves or rejects many pending invoices in one request.
+
+    Each invoice is an independent conditional update (status = Pending,
+    and for non-admins approver = caller), run in parallel, so one stale or
+    foreign invoice never blocks the rest. Returns one outcome per invoice:
+    updated, not_found, not_pending, forbidden, version_conflict or error.
+    An Idempotency-Key header makes retries replay the first response.
+    """
+    body = request.json()
+    if not isinstance(body, dict):
+        return format_response(400, message="Invalid JSON body")
+
+    updates, errors = _normalize_updates(body)
+    if errors:
+        return format_response(400, message="Validation Error", errors=errors)
+
+    user_email = request.principal_email
+    employee = get_employee(user_email) if user_email else None
+    if not employee:
+        return format_response(403, message="Employee record not found for the logged-in user")
+
+    access_role = list(employee.get("access_role", []))
+    if "admin" not in access_role and "approver" not in access_role:
+        return format_response(403, message="Only approvers can approve or reject invoices")
+    # Approvers may only decide invoices assigned to them; admins may decide any
+    restrict_to_approver = "admin" not in access_role
+
+    with ThreadPoolExecutor(max_workers=max(1, min(BULK_STATUS_WORKERS, len(updates)))) as pool:
+        results = list(pool.map(
+            lambda update: transition(update, employee["email"], restrict_to_approver),
+            updates
+        ))
+
+    updated = sum(1 for r in results if r["outcome"] == "updated")
+    return format_response(
+        200 if updated == len(results) else 207,
+        message=f"Updated {updated} of {len(results)} invoices",
+        data={"updated": updated, "results": results}
+    )
+
+lambda_handler = api_handler(timing, map_errors, authenticate, idempotent("bulk_update_status"))(update_statuses)
@@ -0,0 +1,34 @@
+from common import EMPLOYEE_TABLE, ACCOUNTS_TABLE, bump_generation, build_directory_snapshot
+
+# Source table -> cached domain invalidated by its writes
+TABLE_DOMAINS = {
+    EMPLOYEE_TABLE.name: "employees",
+    ACCOUNTS_TABLE.name: "accounts",
+}
+
+def _table_of(record):
+    # arn:aws:dynamodb:<region>:<account>:table/<name>/stream/<label>
+    return record.get("eventSourceARN", "").split(":table/", 1)[-1].split("/", 1)[0]
+
+def lambda_handler(event, context):
+    """
+    DynamoDB Streams consumer for the reference tables. Bumps the generation
+    of each domain touched by the batch once, so every container's cache of
+    it reloads within GENERATION_CHECK_INTERVAL_SECONDS, and rewrites the
+    employee directory snapshot after Employees changes. Edits made from the
+    console or scripts are covered too, not only writes from these Lambdas.
+
+    Can also be invoked directly with {"domains": ["employees", ...]}.
+    """
+    domains = set(event.get("domains") or [])
+    for record in event.get("Records", []):
+        domain = TABLE_DOMAINS.get(_table_of(record))
+        if domain:
+            domains.add(domain)
+
+    generations = {domain: bump_generation(domain) for domain in sorted(domains)}
+    print(f"Bumped generations: {generations}")
+    if "employees" in generations:
+        # Tagged with the new generation so containers accept it as current
+        print(f"Directory snapshot written: {build_directory_snapshot(generations['employees'])}")
+    return {"generations": generations}
@@ -5,12 +5,22 @@ import hashlib
 import secrets
 import json
 import base64
+import io
+import re
+import uuid
+import random
+import threading
+import bisect
+import gzip
+from datetime import datetime
 from decimal import Decimal
-from io import BytesIO
 
 import boto3
 import jwt
-from requests_toolbelt.multipart import decoder
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.types import TypeDeserializer
 
 # =========================================================
 # AWS CONFIGURATION (Switch between Local and Production)
@@ -31,6 +41,9 @@ S3 = boto3.client(
     endpoint_url=LOCALSTACK_URL,        # ✅ Remove for production (real AWS S3)
     aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID", "test"),
     aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY", "test"),
+    # SigV4 everywhere: the default in us-east-1 presigns with SigV2, which
+    # can't sign Content-Length into upload URLs
+    config=Config(signature_version="s3v4"),
 )
 BUCKET_NAME = os.getenv("BUCKET_NAME", "my-bucket")  # ✅ Replace in production
 
@@ -49,6 +62,15 @@ INVOICE_TABLE = DYNAMODB.Table("Invoices")
 EMPLOYEE_TABLE = DYNAMODB.Table("Employees")
 OTP_TABLE = DYNAMODB.Table("OtpStore")
 REFRESH_TOKENS_TABLE = DYNAMODB.Table("RefreshTokens")  # Requires SAM resource
+ATTACHMENTS_TABLE = DYNAMODB.Table("Attachments")       # sha256 digest -> upload state + ref_count + previews ("key#<key>" rows: previews only)
+LINE_ITEMS_TABLE = DYNAMODB.Table("InvoiceLineItems")   # reference_id + "[<generation>#]item#<id>" (collection layout)
+COUNTERS_TABLE = DYNAMODB.Table("InvoiceCounters")      # "MMYYYY" prefix -> last reference number; "generation#<domain>"
+IDEMPOTENCY_TABLE = DYNAMODB.Table("IdempotencyKeys")   # scope#principal#key -> lock + cached response (TTL)
+ACCOUNTS_TABLE = DYNAMODB.Table(os.getenv("ACCOUNTS_TABLE_NAME", "AccountsTable"))
+
+DYNAMODB_CLIENT = DYNAMODB.meta.client  # Shares the resource's Python <-> DynamoDB type serializer
+TransactionCanceledException = DYNAMODB_CLIENT.exceptions.TransactionCanceledException
+_TYPE_DESERIALIZER = TypeDeserializer()
 
 # =========================================================
 # SES CLIENT
@@ -68,6 +90,84 @@ if SES_MOCK_MODE:
 else:
     SES = boto3.client("ses", region_name=AWS_REGION)  # Uses prod creds/roles
 
+# =========================================================
+# OTP EMAIL DISPATCH (sync | sqs | lambda | memory)
+# =========================================================
+# sync   -> SES.send_email inline (old behaviour)
+# sqs    -> enqueue to OTP_QUEUE_URL, OtpSenderFunction sends in batches
+# lambda -> async invoke (InvocationType=Event) of OTP_SENDER_FUNCTION
+# memory -> append to LOCAL_OTP_OUTBOX (tests / local dev)
+OTP_DISPATCH_MODE = os.getenv("OTP_DISPATCH_MODE", "sync").lower()
+OTP_QUEUE_URL = os.getenv("OTP_QUEUE_URL", "")
+OTP_SENDER_FUNCTION = os.getenv("OTP_SENDER_FUNCTION", "")
+OTP_SEND_MAX_RETRIES = int(os.getenv("OTP_SEND_MAX_RETRIES", "3"))
+OTP_QUEUED_MODES = ("sqs", "lambda")  # Send by reference; the code stays in OTP_TABLE
+
+SQS = boto3.client(
+    "sqs",
+    region_name=AWS_REGION,
+    endpoint_url=LOCALSTACK_URL,        # ✅ Remove for production (real AWS SQS)
+    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID", "test"),
+    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY", "test"),
+)
+LAMBDA_CLIENT = boto3.client(
+    "lambda",
+    region_name=AWS_REGION,
+    endpoint_url=LOCALSTACK_URL,        # ✅ Remove for production (real AWS Lambda)
+    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID", "test"),
+    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY", "test"),
+)
+
+LOCAL_OTP_OUTBOX = []  # In-memory stand-in used when OTP_DISPATCH_MODE == "memory"
+
+def send_otp_email(email, otp_code, raise_errors=None):
+    """
+    Send the OTP email through SES (blocking).
+    Errors are swallowed in SES_MOCK_MODE unless raise_errors=True.
+    """
+    if raise_errors is None:
+        raise_errors = not SES_MOCK_MODE
+    subject = "Your OTP Code"
+    body_text = f"Your OTP code is: {otp_code}\nIt is valid for 5 minutes."
+    try:
+        SES.send_email(
+            Source=EMAIL_SOURCE,
+            Destination={"ToAddresses": [email]},
+            Message={
+                "Subject": {"Data": subject},
+                "Body": {"Text": {"Data": body_text}}
+            },
+        )
+    except Exception as e:
+        print(f"Error sending email: {e}")
+        if raise_errors:
+            raise
+
+def dispatch_otp_email(email, otp_code, nonce=None):
+    """
+    Hand the OTP email off according to OTP_DISPATCH_MODE.
+    Only the "sync" mode waits on SES; every other mode returns as soon as
+    the message is queued so SES latency/throttling stays off the login path.
+
+    Queued modes (sqs, lambda) carry only {"email", "nonce"}: the code waits
+    in the OTP item (outbox_code, tagged outbox_nonce) and OtpSenderFunction
+    reads it from there, so no secret ever sits in the queue or DLQ.
+    """
+    if OTP_DISPATCH_MODE in OTP_QUEUED_MODES:
+        message = {"email": email, "nonce": nonce}
+        if OTP_DISPATCH_MODE == "sqs":
+            SQS.send_message(QueueUrl=OTP_QUEUE_URL, MessageBody=json.dumps(message))
+        else:
+            LAMBDA_CLIENT.invoke(
+                FunctionName=OTP_SENDER_FUNCTION,
+                InvocationType="Event",
+                Payload=json.dumps({"messages": [message]}).encode("utf-8"),
+            )
+    elif OTP_DISPATCH_MODE == "memory":
+        LOCAL_OTP_OUTBOX.append({"email": email, "otp_code": otp_code})
+    else:
+        send_otp_email(email, otp_code)
+
 # =========================================================
 # RESPONSES & UTILS
 # =========================================================
@@ -113,46 +213,1620 @@ def decimal_to_float(obj):
         return float(obj)
     return obj
 
+def get_header(event, name):
+    """Case-insensitive request header lookup (API Gateway keeps the client's casing)."""
+    name = name.lower()
+    headers = event.get("headers") or {}
+    if name in headers:
+        return headers[name]
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+# -------- Optimistic versioning --------
+# Every invoice write does "ADD #version :one"; invoices written before
+# versioning existed read as version 0.
+VERSION_NAMES = {"#version": "version"}
+
+def invoice_version(invoice):
+    return int(invoice.get("version", 0))
+
+def etag_of(invoice):
+    return f'"{invoice_version(invoice)}"'
+
+def with_int_version(invoice):
+    """decimal_to_float turns the version into 1.0, which If-Match rejects; keep it an int."""
+    if "version" in invoice:
+        invoice["version"] = invoice_version(invoice)
+    return invoice
+
+def parse_if_match(event):
+    """
+    Expected version from an If-Match header ("3", W/"3" or 3), None when the
+    header is absent or "*". Raises ValueError for anything else.
+    """
+    value = (get_header(event, "If-Match") or "").strip()
+    if not value or value == "*":
+        return None
+    if value.startswith("W/"):
+        value = value[2:]
+    value = value.strip('"')
+    if not value.isdigit():
+        raise ValueError(f"If-Match must be an invoice version, got {value!r}")
+    return int(value)
+
+def version_condition(expected):
+    """ConditionExpression fragment + values for an If-Match precondition."""
+    if expected is None:
+        return None, {}
+    if expected == 0:
+        return "attribute_not_exists(#version)", {}
+    return "#version = :expected_version", {":expected_version": expected}
+
 def get_employee(email):
     """Fetch employee details from DynamoDB."""
     resp = EMPLOYEE_TABLE.get_item(Key={"email": email})
     return resp.get("Item")
 
-def parse_multipart(event):
-    """Parse multipart/form-data requests (file uploads)."""
-    form_data = {}
-    file_data = None
+# =========================================================
+# MULTIPART PARSING & S3 STREAMING
+# =========================================================
+S3_MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD", str(8 * 1024 * 1024)))
+S3_MULTIPART_CHUNK_SIZE = max(int(os.getenv("S3_MULTIPART_CHUNK_SIZE", str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+
+_DISPOSITION_PARAM_RE = re.compile(rb'(\w+)="([^"]*)"|(\w+)=([^;\s]+)')
+
+class MemoryviewReader(io.RawIOBase):
+    """
+    Read-only, seekable file object over a memoryview. Lets boto3 stream a
+    slice of the decoded request body without copying it into a new buffer.
+    """
+    def __init__(self, view):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self._view) - self._pos)
+        if n <= 0:
+            return 0
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, min(offset, len(self._view)))
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+def _decode_event_body(event):
+    """Decode the API Gateway body once; every part is a slice of this buffer."""
+    if event.get("isBase64Encoded"):
+        return base64.b64decode(event.get("body") or "")
+    return (event.get("body") or "").encode("utf-8")
+
+def _parse_disposition(value):
+    params = {}
+    for m in _DISPOSITION_PARAM_RE.finditer(value):
+        key = (m.group(1) or m.group(3)).lower()
+        params[key] = m.group(2) if m.group(1) else m.group(4)
+    return params
+
+def iter_multipart(event):
+    """
+    Stream the parts of a multipart/form-data request.
 
+    Yields dicts: {"name", "filename", "content_type", "content"} where
+    "content" is a memoryview slice of the decoded body (no per-part copy)
+    and "filename" is None for plain form fields.
+    """
     headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
-    content_type = headers.get("content-type")
-    if not content_type or not content_type.startswith("multipart/form-data"):
-        return form_data, file_data
+    content_type = headers.get("content-type") or ""
+    if not content_type.startswith("multipart/form-data"):
+        return
+
+    boundary = None
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "boundary":
+            boundary = value.strip('"')
+    if not boundary:
+        raise ValueError("multipart/form-data request is missing a boundary")
+
+    body = _decode_event_body(event)
+    view = memoryview(body)
+    delimiter = b"--" + boundary.encode("latin-1")
+
+    pos = body.find(delimiter)
+    while pos != -1:
+        pos += len(delimiter)
+        if body[pos:pos + 2] == b"--":  # closing delimiter
+            return
+        header_end = body.find(b"\r\n\r\n", pos)
+        if header_end == -1:
+            return
+        next_delim = body.find(b"\r\n" + delimiter, header_end + 4)
+        if next_delim == -1:
+            raise ValueError("multipart/form-data body is truncated")
 
-    body_bytes = base64.b64decode(event["body"]) if event.get("isBase64Encoded") else (event.get("body") or "").encode("utf-8")
-    multipart_data = decoder.MultipartDecoder(body_bytes, content_type)
+        part_headers = {}
+        for line in body[pos:header_end].split(b"\r\n"):
+            key, sep, value = line.partition(b":")
+            if sep:
+                part_headers[key.strip().lower()] = value.strip()
 
-    for part in multipart_data.parts:
-        content_disposition = part.headers.get(b"Content-Disposition", b"")
-        if b"filename" in content_disposition:
-            filename_bytes = content_disposition.split(b"filename=")[1].strip(b'"')
+        disposition = _parse_disposition(part_headers.get(b"content-disposition", b""))
+        filename = disposition.get(b"filename")
+        yield {
+            "name": disposition.get(b"name", b"").decode("utf-8", "ignore"),
+            "filename": filename.decode("utf-8", "ignore") if filename is not None else None,
+            "content_type": part_headers.get(b"content-type", b"").decode("latin-1") or None,
+            "content": view[header_end + 4:next_delim],
+        }
+        pos = next_delim + 2
+
+def parse_multipart(event):
+    """
+    Parse multipart/form-data requests (file uploads).
+    Returns (form_data, file_data); file_data["content"] is a memoryview that
+    can be passed straight to upload_stream_to_s3.
+    """
+    form_data = {}
+    file_data = None
+
+    for part in iter_multipart(event):
+        if part["filename"] is not None:
             file_data = {
-                "filename": filename_bytes.decode("utf-8", "ignore"),
-                "content": part.content,
+                "filename": part["filename"],
+                "content_type": part["content_type"],
+                "content": part["content"],
             }
         else:
-            name_bytes = content_disposition.split(b"name=")[1].strip(b'"')
             try:
-                form_data[name_bytes.decode("utf-8")] = part.content.decode("utf-8")
+                form_data[part["name"]] = str(part["content"], "utf-8")
             except UnicodeDecodeError:
-                form_data[name_bytes.decode("utf-8")] = part.content.decode("latin-1")
+                form_data[part["name"]] = str(part["content"], "latin-1")
 
     return form_data, file_data
 
+def upload_stream_to_s3(content, bucket, key, content_type=None):
+    """
+    Upload bytes/memoryview to S3 without extra copies: a single PutObject
+    below S3_MULTIPART_THRESHOLD, otherwise a multipart upload whose parts are
+    slices of the same buffer. Aborts the multipart upload on failure.
+    """
+    view = memoryview(content)
+    extra = {"ContentType": content_type} if content_type else {}
+
+    if len(view) < S3_MULTIPART_THRESHOLD:
+        S3.put_object(Bucket=bucket, Key=key, Body=MemoryviewReader(view), ContentLength=len(view), **extra)
+        return
+
+    upload_id = S3.create_multipart_upload(Bucket=bucket, Key=key, **extra)["UploadId"]
+    try:
+        parts = []
+        for number, offset in enumerate(range(0, len(view), S3_MULTIPART_CHUNK_SIZE), start=1):
+            chunk = view[offset:offset + S3_MULTIPART_CHUNK_SIZE]
+            resp = S3.upload_part(
+                Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                Body=MemoryviewReader(chunk), ContentLength=len(chunk),
+            )
+            parts.append({"PartNumber": number, "ETag": resp["ETag"]})
+        S3.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+        )
+    except Exception:
+        S3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+# -------- Presigned direct-to-S3 uploads --------
+ATTACHMENT_PREFIX = "invoices/"
+UPLOAD_URL_TTL_SECONDS = int(os.getenv("UPLOAD_URL_TTL_SECONDS", "900"))                    # 15 min
+MAX_ATTACHMENT_BYTES = int(os.getenv("MAX_ATTACHMENT_BYTES", str(100 * 1024 * 1024)))       # 100 MB
+
+def new_attachment_key(filename):
+    """Unique S3 key for an invoice attachment."""
+    safe_name = re.sub(r"[^A-Za-z0-9._-]", "_", os.path.basename(filename or "file"))
+    return f"{ATTACHMENT_PREFIX}{uuid.uuid4()}_{safe_name}"
+
+def presign_upload(key, size, content_type=None, sha256=None):
+    """
+    Presign a direct browser -> S3 upload for key.
+    Small files get a single PUT URL; files at or above S3_MULTIPART_THRESHOLD
+    get a multipart upload with one presigned URL per part (the client sends
+    the returned ETags to complete_presigned_upload).
+
+    The declared size is signed into every URL as Content-Length (S3 is a
+    SigV4 client, so X-Amz-SignedHeaders includes content-length), and S3
+    rejects a body of any other length. MAX_ATTACHMENT_BYTES is enforced
+    again on the stored object when the upload is completed or referenced.
+
+    If the client supplies the file's sha256 (hex) for a single-PUT upload,
+    the object is content-addressed: S3 verifies the checksum on PUT, and if
+    the digest is already stored the response is {"method": "EXISTS"} and
+    the client can skip the upload entirely.
+    """
+    extra = {"ContentType": content_type} if content_type else {}
+
+    if size < S3_MULTIPART_THRESHOLD:
+        headers = {"Content-Type": content_type} if content_type else {}
+        if sha256:
+            key = content_addressed_key(sha256)
+            if attachment_exists(key):
+                return {"method": "EXISTS", "key": key}
+            checksum = base64.b64encode(bytes.fromhex(sha256)).decode("ascii")
+            extra["ChecksumSHA256"] = checksum
+            headers["x-amz-checksum-sha256"] = checksum
+
+        url = S3.generate_presigned_url(
+            "put_object",
+            Params={"Bucket": BUCKET_NAME, "Key": key, "ContentLength": size, **extra},
+            ExpiresIn=UPLOAD_URL_TTL_SECONDS,
+        )
+        return {
+            "method": "PUT",
+            "key": key,
+            "url": url,
+            "headers": headers,
+            "expires_in": UPLOAD_URL_TTL_SECONDS,
+        }
+
+    upload_id = S3.create_multipart_upload(Bucket=BUCKET_NAME, Key=key, **extra)["UploadId"]
+    part_count = -(-size // S3_MULTIPART_CHUNK_SIZE)
+    parts = [
+        {
+            "part_number": n,
+            "url": S3.generate_presigned_url(
+                "upload_part",
+                Params={"Bucket": BUCKET_NAME, "Key": key, "UploadId": upload_id, "PartNumber": n,
+                        "ContentLength": min(S3_MULTIPART_CHUNK_SIZE, size - (n - 1) * S3_MULTIPART_CHUNK_SIZE)},
+                ExpiresIn=UPLOAD_URL_TTL_SECONDS,
+            ),
+        }
+        for n in range(1, part_count + 1)
+    ]
+    return {
+        "method": "MULTIPART",
+        "key": key,
+        "upload_id": upload_id,
+        "part_size": S3_MULTIPART_CHUNK_SIZE,
+        "parts": parts,
+        "expires_in": UPLOAD_URL_TTL_SECONDS,
+    }
+
+def complete_presigned_upload(key, upload_id, parts):
+    """
+    Complete a presigned multipart upload from the client's [{part_number, etag}].
+    Raises ValueError (and deletes the object) if it exceeds MAX_ATTACHMENT_BYTES.
+    """
+    S3.complete_multipart_upload(
+        Bucket=BUCKET_NAME,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={"Parts": sorted(
+            ({"PartNumber": int(p["part_number"]), "ETag": p["etag"]} for p in parts),
+            key=lambda p: p["PartNumber"],
+        )},
+    )
+    if _discard_if_oversized(key, head_attachment(key)):
+        raise ValueError(f"Attachment exceeds {MAX_ATTACHMENT_BYTES} bytes and was discarded")
+
+def head_attachment(key):
+    """HeadObject an uploaded attachment; returns its metadata or None if missing."""
+    try:
+        return S3.head_object(Bucket=BUCKET_NAME, Key=key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+def _discard_if_oversized(key, head):
+    """Delete an uploaded object larger than MAX_ATTACHMENT_BYTES; True if it was."""
+    if not head or int(head.get("ContentLength") or 0) <= MAX_ATTACHMENT_BYTES:
+        return False
+    print(f"Discarding oversized attachment {key}: {head.get('ContentLength')} bytes")
+    S3.delete_object(Bucket=BUCKET_NAME, Key=key)
+    return True
+
+# -------- Content-addressed attachments (dedup + ref counts) --------
+# Attachments live under invoices/sha256/<digest>. ATTACHMENTS_TABLE tracks
+# whether the digest is uploaded and how many invoices reference it, so a
+# repeat upload is one GetItem and deletes only remove unreferenced objects.
+#
+# An index row is live (uploaded = true) or being deleted (deleting = true).
+# Invoices claim a reference with a conditional ADD on a live row before they
+# are written, and the S3 object is only deleted under a "deleting" row, which
+# neither claims nor re-uploads can revive. So no invoice can end up pointing
+# at an object that a release or the reconciler is removing.
+CONTENT_ADDRESSED_PREFIX = ATTACHMENT_PREFIX + "sha256/"
+SHA256_HEX_RE = re.compile(r"^[0-9a-f]{64}$")
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+def sha256_of(content):
+    """SHA-256 hex digest of bytes/memoryview, hashed in chunks without copying."""
+    view = memoryview(content)
+    h = hashlib.sha256()
+    for offset in range(0, len(view), _HASH_CHUNK_SIZE):
+        h.update(view[offset:offset + _HASH_CHUNK_SIZE])
+    return h.hexdigest()
+
+def content_addressed_key(digest):
+    return f"{CONTENT_ADDRESSED_PREFIX}{digest}"
+
+def digest_of_key(key):
+    """Digest of a content-addressed key, or None for legacy uuid keys."""
+    if key and key.startswith(CONTENT_ADDRESSED_PREFIX):
+        return key[len(CONTENT_ADDRESSED_PREFIX):]
+    return None
+
+def _mark_attachment_uploaded(digest, size=None, content_type=None):
+    """Record the digest as uploaded; False if it is being deleted."""
+    try:
+        ATTACHMENTS_TABLE.update_item(
+            Key={"digest": digest},
+            UpdateExpression=(
+                "SET uploaded = :true, s3_key = :key, size_bytes = if_not_exists(size_bytes, :size), "
+                "content_type = if_not_exists(content_type, :ct), created_at = if_not_exists(created_at, :now)"
+            ),
+            ConditionExpression="attribute_not_exists(deleting)",
+            ExpressionAttributeValues={
+                ":true": True,
+                ":key": content_addressed_key(digest),
+                ":size": size,
+                ":ct": content_type,
+                ":now": int(time.time()),
+            },
+        )
+        return True
+    except DYNAMODB_CLIENT.exceptions.ConditionalCheckFailedException:
+        return False
+
+def attachment_exists(key):
+    """
+    True if the attachment is in S3. Content-addressed keys are answered from
+    the digest index first (HeadObject only on a miss, then recorded).
+    Objects over MAX_ATTACHMENT_BYTES are deleted and reported missing, and
+    so are digests that are being deleted.
+    """
+    digest = digest_of_key(key)
+    if digest:
+        item = ATTACHMENTS_TABLE.get_item(Key={"digest": digest}).get("Item") or {}
+        if item.get("uploaded"):
+            return True
+        if item.get("deleting"):
+            return False
+    head = head_attachment(key)
+    if _discard_if_oversized(key, head):
+        return False
+    if head and digest:
+        return _mark_attachment_uploaded(digest, head.get("ContentLength"), head.get("ContentType"))
+    return head is not None
+
+def store_attachment(content, content_type=None):
+    """
+    Store an attachment under its SHA-256 digest, skipping the upload when the
+    same bytes are already stored. Returns the content-addressed key.
+    Call claim_attachment_reference before writing the owning invoice.
+    """
+    digest = sha256_of(content)
+    key = content_addressed_key(digest)
+    if not attachment_exists(key):
+        upload_stream_to_s3(content, BUCKET_NAME, key, content_type=content_type)
+        _mark_attachment_uploaded(digest, len(memoryview(content)), content_type)
+    return key
+
+def claim_attachment_reference(key):
+    """
+    Count one more invoice referencing key, atomically with the check that it
+    is uploaded and not being deleted. Call before writing the invoice, and
+    release_attachment if that write fails. False means there is nothing to
+    reference (never uploaded, or removed meanwhile).
+    Legacy uuid keys are not reference counted; they only need to exist.
+    """
+    digest = digest_of_key(key)
+    if not digest:
+        return attachment_exists(key)
+    for attempt in range(2):
+        try:
+            ATTACHMENTS_TABLE.update_item(
+                Key={"digest": digest},
+                UpdateExpression="ADD ref_count :one",
+                ConditionExpression="uploaded = :true",
+                ExpressionAttributeValues={":one": 1, ":true": True},
+            )
+            return True
+        except DYNAMODB_CLIENT.exceptions.ConditionalCheckFailedException:
+            # Not indexed yet (fresh presigned upload): record it from S3 and retry once
+            if attempt or not attachment_exists(key):
+                return False
+    return False
+
+def begin_attachment_deletion(digest):
+    """
+    Turn an unreferenced index row into a "deleting" tombstone (creating it if
+    absent). False if the digest is referenced or already being deleted.
+    """
+    try:
+        ATTACHMENTS_TABLE.update_item(
+            Key={"digest": digest},
+            UpdateExpression="SET deleting = :true, uploaded = :false",
+            ConditionExpression=(
+                "attribute_not_exists(deleting) AND "
+                "(attribute_not_exists(ref_count) OR ref_count <= :zero)"
+            ),
+            ExpressionAttributeValues={":true": True, ":false": False, ":zero": 0},
+        )
+        return True
+    except DYNAMODB_CLIENT.exceptions.ConditionalCheckFailedException:
+        return False
+
+def forget_attachment_previews(key):
+    """Drop the previews row of a deleted uuid-key attachment (digest rows go with the digest)."""
+    if not digest_of_key(key):
+        ATTACHMENTS_TABLE.delete_item(Key=_previews_row_key(key))
+
+def finish_attachment_deletion(digest):
+    """Drop the tombstone once the S3 object is gone; the digest can be uploaded again."""
+    ATTACHMENTS_TABLE.delete_item(
+        Key={"digest": digest},
+        ConditionExpression="deleting = :true",
+        ExpressionAttributeValues={":true": True},
+    )
+
+def release_attachment(key):
+    """
+    Drop one invoice reference; when none remain, delete the S3 object under
+    a "deleting" tombstone (a concurrent claim wins the race or fails
+    cleanly), then the index row.
+    Legacy uuid keys are left for the orphan reconciliation job.
+    """
+    digest = digest_of_key(key)
+    if not digest:
+        return
+    resp = ATTACHMENTS_TABLE.update_item(
+        Key={"digest": digest},
+        UpdateExpression="ADD ref_count :minus_one",
+        ConditionExpression="attribute_exists(digest)",
+        ExpressionAttributeValues={":minus_one": -1},
+        ReturnValues="UPDATED_NEW",
+    )
+    if int(resp["Attributes"].get("ref_count", 0)) > 0:
+        return
+    if not begin_attachment_deletion(digest):
+        return  # Re-referenced in the meantime
+    S3.delete_object(Bucket=BUCKET_NAME, Key=key)
+    finish_attachment_deletion(digest)
+
+# -------- Presigned downloads (cached per warm container) --------
+DOWNLOAD_URL_TTL_SECONDS = int(os.getenv("DOWNLOAD_URL_TTL_SECONDS", "3600"))               # 1 hour
+DOWNLOAD_URL_REFRESH_MARGIN_SECONDS = int(os.getenv("DOWNLOAD_URL_REFRESH_MARGIN_SECONDS", "300"))
+DOWNLOAD_URL_CACHE_MAX_ENTRIES = int(os.getenv("DOWNLOAD_URL_CACHE_MAX_ENTRIES", "5000"))
+_DOWNLOAD_URL_CACHE = {}  # key -> (url, expires_at)
+
+def presigned_download_url(key):
+    """
+    Presigned GET URL for an attachment key. Signatures are reused until
+    DOWNLOAD_URL_REFRESH_MARGIN_SECONDS before they expire, so repeated
+    list polls don't re-sign the same keys.
+    """
+    now = time.time()
+    cached = _DOWNLOAD_URL_CACHE.get(key)
+    if cached and cached[1] - DOWNLOAD_URL_REFRESH_MARGIN_SECONDS > now:
+        return cached[0]
+
+    url = S3.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": BUCKET_NAME, "Key": key},
+        ExpiresIn=DOWNLOAD_URL_TTL_SECONDS,
+    )
+    if len(_DOWNLOAD_URL_CACHE) >= DOWNLOAD_URL_CACHE_MAX_ENTRIES:
+        # Drop the oldest entry (dicts keep insertion order)
+        _DOWNLOAD_URL_CACHE.pop(next(iter(_DOWNLOAD_URL_CACHE)))
+    _DOWNLOAD_URL_CACHE.pop(key, None)
+    _DOWNLOAD_URL_CACHE[key] = (url, now + DOWNLOAD_URL_TTL_SECONDS)
+    return url
+
+def attachment_key_of(invoice):
+    """
+    S3 key of an invoice's attachment, or None. Falls back to parsing the
+    legacy "{LOCALSTACK_URL}/{BUCKET_NAME}/{key}" file_url of older invoices.
+    """
+    key = invoice.get("file_key")
+    if key:
+        return key
+    file_url = invoice.get("file_url") or ""
+    marker = f"/{BUCKET_NAME}/"
+    if marker in file_url:
+        return file_url.split(marker, 1)[1]
+    return None
+
+def with_attachment_url(invoice):
+    """
+    Set invoice["file_url"] (and "preview_url" when a thumbnail exists) to
+    fresh presigned GET URLs for API responses.
+    """
+    key = attachment_key_of(invoice)
+    invoice["file_key"] = key
+    invoice["file_url"] = presigned_download_url(key) if key else None
+    thumbnail_key = (invoice.get("previews") or {}).get("thumbnail")
+    invoice["preview_url"] = presigned_download_url(thumbnail_key) if thumbnail_key else None
+    return invoice
+
+# -------- Attachment derivatives (thumbnails / recompressed copies) --------
+# Derivatives live under previews/ mirroring the attachment key, outside the
+# invoices/ prefix so they neither re-trigger the pipeline nor look like
+# orphaned attachments. Their keys are recorded in ATTACHMENTS_TABLE for every
+# attachment: on the digest row for content-addressed keys, and on a
+# "key#<object key>" row for uuid keys (presigned multipart uploads), whose
+# pipeline run usually finishes before the invoice exists.
+PREVIEWS_PREFIX = "previews/"
+
+def derivative_key(key, suffix):
+    """previews/<key without invoices/>.<suffix>, e.g. thumb.webp"""
+    return f"{PREVIEWS_PREFIX}{key[len(ATTACHMENT_PREFIX):]}.{suffix}"
+
+def _previews_row_key(key):
+    """ATTACHMENTS_TABLE key of the row holding key's derivatives."""
+    return {"digest": digest_of_key(key) or f"key#{key}"}
+
+def attachment_previews(key):
+    """Derivative keys recorded for an attachment ({} if none yet)."""
+    item = ATTACHMENTS_TABLE.get_item(Key=_previews_row_key(key), ProjectionExpression="previews").get("Item")
+    return (item or {}).get("previews") or {}
+
+def backfill_invoice_previews(reference_id, key):
+    """
+    Copy key's derivatives onto a just-written invoice that has none, for
+    when the pipeline recorded them between the invoice's lookup and its
+    write (its GSI query could not see the invoice yet). Returns them ({}).
+    """
+    previews = attachment_previews(key)
+    if previews:
+        try:
+            INVOICE_TABLE.update_item(
+                Key={"reference_id": reference_id},
+                UpdateExpression="SET previews = :p",
+                ConditionExpression="attribute_exists(reference_id) AND attribute_not_exists(previews)",
+                ExpressionAttributeValues={":p": previews},
+            )
+        except DYNAMODB_CLIENT.exceptions.ConditionalCheckFailedException:
+            pass  # Deleted, or the pipeline got there first
+    return previews
+
+def record_attachment_previews(key, previews):
+    """
+    Store derivative keys on the Attachments index (any key, see above) and
+    on every invoice that references key (Invoices GSI "file_key-index").
+    Returns the number of invoices updated.
+    """
+    ATTACHMENTS_TABLE.update_item(
+        Key=_previews_row_key(key),
+        UpdateExpression="SET previews = :p",
+        ExpressionAttributeValues={":p": previews},
+    )
+
+    updated = 0
+    query_kwargs = {
+        "IndexName": "file_key-index",
+        "KeyConditionExpression": Key("file_key").eq(key),
+        "ProjectionExpression": "reference_id",
+    }
+    while True:
+        page = INVOICE_TABLE.query(**query_kwargs)
+        for item in page.get("Items", []):
+            INVOICE_TABLE.update_item(
+                Key={"reference_id": item["reference_id"]},
+                UpdateExpression="SET previews = :p",
+                ConditionExpression="attribute_exists(reference_id)",
+                ExpressionAttributeValues={":p": previews},
+            )
+            updated += 1
+        if "LastEvaluatedKey" not in page:
+            return updated
+        query_kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
 def is_valid_workmail_user(email):
     with open("workmail.json") as f:
         data = json.load(f)
     return email.lower() in (user.lower() for user in data.get("users", []))
 
+# =========================================================
+# REFERENCE DATA CACHE (accounts, employee directory)
+# =========================================================
+# Accounts and employees change maybe weekly, so each warm container keeps
+# them in memory. Past the TTL the next caller reloads synchronously: Lambda
+# freezes the container between invocations, so a background refresh would
+# stall until the next request anyway. If that reload fails, the stale copy
+# is served for up to REFERENCE_CACHE_MAX_STALE_SECONDS more.
+#
+# Cross-container invalidation: every cached domain has a generation
+# counter ("generation#<domain>" in COUNTERS_TABLE) that writers bump.
+# Readers re-read it at most every GENERATION_CHECK_INTERVAL_SECONDS and
+# reload as soon as it moves, so long TTLs still converge within seconds.
+REFERENCE_CACHE_TTL_SECONDS = int(os.getenv("REFERENCE_CACHE_TTL_SECONDS", "3600"))
+REFERENCE_CACHE_MAX_STALE_SECONDS = int(os.getenv("REFERENCE_CACHE_MAX_STALE_SECONDS", "3600"))
+REFERENCE_CACHE_MAX_BYTES = int(os.getenv("REFERENCE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+GENERATION_CHECK_INTERVAL_SECONDS = float(os.getenv("GENERATION_CHECK_INTERVAL_SECONDS", "5"))
+GENERATION_KEY_PREFIX = "generation#"
+_GENERATIONS = {}  # domain -> (generation, checked_at)
+
+def bump_generation(domain):
+    """Invalidate every container's cache of domain; returns the new generation."""
+    resp = COUNTERS_TABLE.update_item(
+        Key={"prefix": GENERATION_KEY_PREFIX + domain},
+        UpdateExpression="ADD generation :one",
+        ExpressionAttributeValues={":one": 1},
+        ReturnValues="UPDATED_NEW",
+    )
+    generation = int(resp["Attributes"]["generation"])
+    _GENERATIONS[domain] = (generation, time.time())
+    return generation
+
+def current_generation(domain):
+    """Domain generation, re-read at most every GENERATION_CHECK_INTERVAL_SECONDS."""
+    now = time.time()
+    cached = _GENERATIONS.get(domain)
+    if cached and now - cached[1] < GENERATION_CHECK_INTERVAL_SECONDS:
+        return cached[0]
+    try:
+        item = COUNTERS_TABLE.get_item(
+            Key={"prefix": GENERATION_KEY_PREFIX + domain},
+            ProjectionExpression="generation",
+        ).get("Item") or {}
+        generation = int(item.get("generation", 0))
+    except ClientError as e:
+        # Keep serving on the last known generation rather than failing the request
+        print(f"Generation check failed for {domain}: {e}")
+        generation = cached[0] if cached else 0
+    _GENERATIONS[domain] = (generation, now)
+    return generation
+
+class ReferenceDataCache:
+    """
+    Single-value cache around a loader function, reloaded synchronously
+    past the TTL and served stale only while the reload fails.
+
+    Worst-case staleness (e.g. an approver removed from Employees): for a
+    domain-following cache, GENERATION_CHECK_INTERVAL_SECONDS once the bump
+    is visible. If the generation can't be read, or the domain is None, the
+    TTL applies; if reloads fail too, ttl + max_stale.
+    """
+
+    def __init__(self, name, loader, ttl=None, max_stale=None, max_bytes=None, domain=None):
+        self.name = name
+        self.loader = loader
+        self.domain = domain  # Generation counter to follow (None: TTL only)
+        self.ttl = REFERENCE_CACHE_TTL_SECONDS if ttl is None else ttl
+        self.max_stale = REFERENCE_CACHE_MAX_STALE_SECONDS if max_stale is None else max_stale
+        self.max_bytes = REFERENCE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self._value = None
+        self._loaded_at = 0.0
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def _load(self, generation=None):
+        # The generation is read before loading: a write racing the load
+        # bumps it again, so the next check reloads
+        if self.domain and generation is None:
+            generation = current_generation(self.domain)
+        value = self.loader()
+        size = len(json.dumps(value, default=str))
+        with self._lock:
+            if size <= self.max_bytes:
+                self._value, self._loaded_at = value, time.time()
+                self._generation = generation
+            else:
+                # Too big to pin in memory: serve it, but don't keep it
+                print(f"{self.name} cache skipped: {size} bytes > {self.max_bytes}")
+                self._value, self._loaded_at = None, 0.0
+        return value
+
+    def get(self):
+        age = time.time() - self._loaded_at
+        value = self._value
+        if value is not None and self.domain:
+            generation = current_generation(self.domain)
+            if generation != self._generation:
+                return self._load(generation)  # Known to be outdated: never serve it
+        if value is not None and age < self.ttl:
+            return value
+        try:
+            return self._load()
+        except Exception as e:
+            if value is None or age >= self.ttl + self.max_stale:
+                raise
+            print(f"{self.name} cache refresh failed, serving stale copy: {e}")
+            return value
+
+    def invalidate(self):
+        with self._lock:
+            self._value, self._loaded_at = None, 0.0
+
+def _scan_all(table, **scan_kwargs):
+    items = []
+    while True:
+        page = table.scan(**scan_kwargs)
+        items.extend(page.get("Items", []))
+        if "LastEvaluatedKey" not in page:
+            return items
+        scan_kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+def _load_accounts():
+    return sorted(_scan_all(ACCOUNTS_TABLE), key=lambda a: a.get("account_name") or "")
+
+def _scan_employee_directory():
+    """
+    email -> employee, with access_role as a sorted list (String Sets aren't JSON).
+    Strongly consistent: both the snapshot and the cache tag the result with
+    the generation read beforehand, so it must include every write that bumped it.
+    """
+    directory = {}
+    for employee in _scan_all(EMPLOYEE_TABLE, ConsistentRead=True):
+        if "access_role" in employee:
+            employee["access_role"] = sorted(employee["access_role"])
+        directory[employee["email"]] = employee
+    return directory
+
+# -------- Employee directory snapshot (S3) --------
+# A gzip'd, columnar JSON copy of the directory tagged with the "employees"
+# generation it was built at. Containers hydrate from this one GET instead
+# of scanning Employees; a snapshot older than the current generation is
+# ignored (the scan is the fallback).
+DIRECTORY_SNAPSHOT_KEY = os.getenv("DIRECTORY_SNAPSHOT_KEY", "reference/employees.json.gz")
+DIRECTORY_SNAPSHOT_FORMAT = 1
+
+def _json_number(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, set):
+        return sorted(value)
+    raise TypeError(f"Not JSON serializable: {type(value).__name__}")
+
+def build_directory_snapshot(generation=None):
+    """Scan Employees and write the snapshot; returns {"generation", "employees", "bytes"}."""
+    if generation is None:
+        generation = current_generation("employees")
+    directory = _scan_employee_directory()
+    fields = sorted({k for e in directory.values() for k in e} - {"email"})
+    snapshot = {
+        "format": DIRECTORY_SNAPSHOT_FORMAT,
+        "generation": generation,
+        "built_at": datetime.utcnow().isoformat(),
+        "fields": fields,
+        "rows": [[email] + [e.get(f) for f in fields] for email, e in sorted(directory.items())],
+    }
+    body = gzip.compress(json.dumps(snapshot, separators=(",", ":"), default=_json_number).encode("utf-8"))
+    S3.put_object(
+        Bucket=BUCKET_NAME,
+        Key=DIRECTORY_SNAPSHOT_KEY,
+        Body=body,
+        ContentType="application/json",
+        ContentEncoding="gzip",
+        Metadata={"generation": str(generation)},
+    )
+    return {"generation": generation, "employees": len(directory), "bytes": len(body)}
+
+def load_directory_snapshot(min_generation=0):
+    """Directory from the S3 snapshot, or None if missing, unreadable or older than min_generation."""
+    try:
+        obj = S3.get_object(Bucket=BUCKET_NAME, Key=DIRECTORY_SNAPSHOT_KEY)
+        if int(obj.get("Metadata", {}).get("generation", -1)) < min_generation:
+            return None
+        snapshot = json.loads(gzip.decompress(obj["Body"].read()))
+    except (ClientError, ValueError, OSError) as e:
+        print(f"Directory snapshot unavailable: {e}")
+        return None
+    if snapshot.get("format") != DIRECTORY_SNAPSHOT_FORMAT:
+        return None
+    fields = snapshot["fields"]
+    return {
+        row[0]: {"email": row[0], **{f: v for f, v in zip(fields, row[1:]) if v is not None}}
+        for row in snapshot["rows"]
+    }
+
+def _load_employee_directory():
+    snapshot = load_directory_snapshot(current_generation("employees"))
+    return snapshot if snapshot is not None else _scan_employee_directory()
+
+ACCOUNTS_CACHE = ReferenceDataCache("accounts", _load_accounts, domain="accounts")
+EMPLOYEE_DIRECTORY_CACHE = ReferenceDataCache("employees", _load_employee_directory, domain="employees")
+
+def cached_accounts():
+    """All Accounts items (shared, treat as read-only)."""
+    return ACCOUNTS_CACHE.get()
+
+def cached_employee_directory():
+    """email -> employee for every employee (shared, treat as read-only)."""
+    return EMPLOYEE_DIRECTORY_CACHE.get()
+
+# -------- Prefix search --------
+class PrefixIndex:
+    """
+    Sorted (term, rank, value) array searched with bisect: a prefix lookup
+    is two binary searches plus a slice, with no per-query scan.
+    """
+
+    def __init__(self, entries):
+        # entries: (text, value) pairs; a value may be listed under several texts
+        self._rows = sorted(
+            (text.strip().lower(), rank, value)
+            for rank, (text, value) in enumerate(entries) if text and text.strip()
+        )
+        self._terms = [row[0] for row in self._rows]
+
+    def search(self, prefix, limit=None):
+        """
+        Values with a term starting with prefix, deduplicated, in entry order.
+        With a limit, the first `limit` values by matching term are taken, so
+        short prefixes stay O(limit) instead of walking the whole range.
+        """
+        prefix = (prefix or "").strip().lower()
+        if not prefix:
+            return []
+        lo = bisect.bisect_left(self._terms, prefix)
+        hi = bisect.bisect_left(self._terms, prefix + "\uffff", lo)
+        ranked = {}
+        for i in range(lo, hi):
+            _, rank, value = self._rows[i]
+            if value in ranked:
+                ranked[value] = min(rank, ranked[value])
+            elif limit and len(ranked) >= limit:
+                break
+            else:
+                ranked[value] = rank
+        return sorted(ranked, key=ranked.get)
+
+def employee_search_terms(employee):
+    """Texts an employee can be found by: first/last/full name and email."""
+    first = (employee.get("first_name") or "").strip()
+    last = (employee.get("last_name") or "").strip()
+    return [t for t in (f"{first} {last}".strip(), last, employee.get("email")) if t]
+
+def employee_sort_key(employee):
+    return (employee.get("last_name") or "", employee.get("first_name") or "", employee["email"])
+
+_EMPLOYEE_VIEW = (None, [], [], None)  # (directory it was built from, sorted employees, their sort keys, PrefixIndex)
+
+def _employee_view():
+    global _EMPLOYEE_VIEW
+    directory = cached_employee_directory()
+    if _EMPLOYEE_VIEW[0] is not directory:
+        ordered = sorted(directory.values(), key=employee_sort_key)
+        index = PrefixIndex((term, e["email"]) for e in ordered for term in employee_search_terms(e))
+        _EMPLOYEE_VIEW = (directory, ordered, [employee_sort_key(e) for e in ordered], index)
+    return _EMPLOYEE_VIEW
+
+def sorted_employees():
+    """Cached directory ordered by last name, first name, email (rebuilt when it reloads)."""
+    return _employee_view()[1]
+
+def sorted_employee_keys():
+    """employee_sort_key of each sorted_employees() entry, for bisecting."""
+    return _employee_view()[2]
+
+def employee_search_index():
+    """PrefixIndex over names and emails of the cached directory; values are emails."""
+    return _employee_view()[3]
+
+def word_prefix_terms(text):
+    """text plus every suffix starting at a word, so "Office Supplies" matches "sup"."""
+    text = (text or "").strip()
+    return [text] + [text[m.start():] for m in re.finditer(r"(?<=\s)\S", text)]
+
+def _as_list(value):
+    if value is None:
+        return []
+    return sorted(value) if isinstance(value, (set, list, tuple)) else [value]
+
+_ACCOUNT_VIEW = (None, None, None)  # (accounts it was built from, account index, project class index)
+
+def _account_view():
+    global _ACCOUNT_VIEW
+    accounts = cached_accounts()
+    if _ACCOUNT_VIEW[0] is not accounts:
+        names = [a["account_name"] for a in accounts if a.get("account_name")]
+        # Project classes are whatever the Accounts items list under project_class(es)
+        classes = sorted({str(c) for a in accounts for key in ("project_class", "project_classes") for c in _as_list(a.get(key))})
+        _ACCOUNT_VIEW = (
+            accounts,
+            PrefixIndex((term, name) for name in names for term in word_prefix_terms(name)),
+            PrefixIndex((term, c) for c in classes for term in word_prefix_terms(c)),
+        )
+    return _ACCOUNT_VIEW
+
+def account_search_index():
+    """PrefixIndex over account names (any word); values are account names."""
+    return _account_view()[1]
+
+def project_class_search_index():
+    """PrefixIndex over project classes found on Accounts items."""
+    return _account_view()[2]
+
+def cached_employee(email):
+    """
+    Employee from the directory cache; falls back to get_item on a miss so
+    someone added since the last refresh is still found.
+    """
+    if not email:
+        return None
+    email = email.strip().lower()
+    employee = cached_employee_directory().get(email)
+    if employee is None:
+        employee = get_employee(email)
+    return employee
+
+# Opt-in warm-up at init so the first request already has the directory
+if os.getenv("PRELOAD_EMPLOYEE_DIRECTORY", "false").lower() == "true":
+    try:
+        EMPLOYEE_DIRECTORY_CACHE.get()
+    except Exception as e:
+        print(f"Employee directory preload failed: {e}")
+
+# =========================================================
+# INVOICE LINE ITEMS (embedded list | item collection)
+# =========================================================
+# "embedded"   -> items is a list attribute on the invoice (original layout)
+# "collection" -> one LINE_ITEMS_TABLE row per item under the invoice's
+#                 reference_id; the invoice only keeps items_layout + item_count.
+# The layout is recorded per invoice, so both can coexist during migration.
+#
+# Whole-list rewrites never touch the live rows: the new set is written under
+# a fresh items_generation ("<generation>#item#<id>"), the header is switched
+# to it with a conditional write, and only then is the old generation deleted.
+# Headers without items_generation use the original "item#<id>" keys.
+INVOICE_ITEMS_LAYOUT = os.getenv("INVOICE_ITEMS_LAYOUT", "embedded").lower()
+ITEMS_LAYOUT_COLLECTION = "collection"
+LINE_ITEM_KEY_PREFIX = "item#"
+_LINE_ITEM_META = ("reference_id", "item_key", "added_at")
+
+def new_items_generation():
+    return uuid.uuid4().hex  # Hex never starts with "item#", so generations can't overlap
+
+def line_item_prefix(generation=None):
+    return f"{generation}#{LINE_ITEM_KEY_PREFIX}" if generation else LINE_ITEM_KEY_PREFIX
+
+def line_item_key(item_id, generation=None):
+    return f"{line_item_prefix(generation)}{item_id}"
+
+def uses_item_collection(invoice):
+    return (invoice or {}).get("items_layout") == ITEMS_LAYOUT_COLLECTION
+
+def items_generation_condition(generation):
+    """Condition (+ values) pinning a header to the row generation the caller wrote into."""
+    if generation is None:
+        return "attribute_not_exists(items_generation)", {}
+    return "items_generation = :items_generation", {":items_generation": generation}
+
+def to_line_item_row(reference_id, item, added_at=None, generation=None):
+    """Line item -> LINE_ITEMS_TABLE row; assigns an id when missing."""
+    item = dict(item)
+    item.setdefault("id", str(uuid.uuid4()))
+    item["id"] = str(item["id"])
+    return {
+        **item,
+        "reference_id": reference_id,
+        "item_key": line_item_key(item["id"], generation),
+        "added_at": added_at if added_at is not None else time.time_ns(),
+    }
+
+def assign_item_ids(items):
+    """
+    Items with a unique string id each, in both layouts, so every item can
+    be addressed by DELETE /items/{id}. Missing ids are generated; a repeated
+    id would be two puts on one key (BatchWriteItem rejects that), so repeats
+    get a fresh one too.
+    """
+    seen, assigned = set(), []
+    for item in items:
+        item_id = str(item["id"]) if item.get("id") is not None else None
+        if item_id is None or item_id in seen:
+            item_id = str(uuid.uuid4())
+        seen.add(item_id)
+        assigned.append({**item, "id": item_id})
+    return assigned
+
+def to_line_item_rows(reference_id, items, generation=None):
+    """Rows for a whole list of items, in order (ids as in assign_item_ids)."""
+    base = time.time_ns()
+    return [to_line_item_row(reference_id, item, base + i, generation) for i, item in enumerate(assign_item_ids(items))]
+
+def from_line_item_row(row):
+    """LINE_ITEMS_TABLE row -> line item as returned by the API."""
+    return {k: v for k, v in row.items() if k not in _LINE_ITEM_META}
+
+def load_line_items(reference_id, generation=None):
+    """All line items of one generation (one paginated Query), in insertion order."""
+    rows = []
+    query_kwargs = {
+        "KeyConditionExpression": Key("reference_id").eq(reference_id)
+        & Key("item_key").begins_with(line_item_prefix(generation)),
+    }
+    while True:
+        page = LINE_ITEMS_TABLE.query(**query_kwargs)
+        rows.extend(page.get("Items", []))
+        if "LastEvaluatedKey" not in page:
+            break
+        query_kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+    rows.sort(key=lambda r: r.get("added_at", 0))
+    return [from_line_item_row(r) for r in rows]
+
+def write_line_items(reference_id, items, generation=None):
+    """Batch-write line items into the collection; returns the items with their ids."""
+    rows = to_line_item_rows(reference_id, items, generation)
+    with LINE_ITEMS_TABLE.batch_writer() as batch:
+        for row in rows:
+            batch.put_item(Item=row)
+    return [from_line_item_row(r) for r in rows]
+
+def delete_line_items(reference_id, prefix=None):
+    """Delete the line item rows of an invoice: all of them, or those under one key prefix."""
+    key_condition = Key("reference_id").eq(reference_id)
+    if prefix is not None:
+        key_condition &= Key("item_key").begins_with(prefix)
+    query_kwargs = {
+        "KeyConditionExpression": key_condition,
+        "ProjectionExpression": "reference_id, item_key",
+    }
+    with LINE_ITEMS_TABLE.batch_writer() as batch:
+        while True:
+            page = LINE_ITEMS_TABLE.query(**query_kwargs)
+            for row in page.get("Items", []):
+                batch.delete_item(Key={"reference_id": row["reference_id"], "item_key": row["item_key"]})
+            if "LastEvaluatedKey" not in page:
+                break
+            query_kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+def with_line_items(invoice):
+    """
+    Fill invoice["items"] from the collection for collection-layout invoices.
+    This is one Query on top of the caller's header read: the header lives in
+    INVOICE_TABLE, not in the item collection.
+
+    A short read means the header was switched to a new generation and the
+    old rows are being deleted; the header is re-read once in that case.
+    """
+    if not uses_item_collection(invoice):
+        return invoice
+    generation = invoice.get("items_generation")
+    invoice["items"] = load_line_items(invoice["reference_id"], generation)
+    if len(invoice["items"]) < invoice.get("item_count", 0):
+        fresh = INVOICE_TABLE.get_item(Key={"reference_id": invoice["reference_id"]}, ConsistentRead=True).get("Item")
+        if fresh and uses_item_collection(fresh) and fresh.get("items_generation") != generation:
+            fresh["items"] = load_line_items(fresh["reference_id"], fresh.get("items_generation"))
+            return fresh
+    return invoice
+
+# =========================================================
+# REQUEST SCHEMAS (declarative, compiled once at import)
+# =========================================================
+# A schema is a dict of name -> Field. compile_schema turns it into one
+# closure per field, so validating a request is a flat loop with no
+# per-call setup. Validators collect every error (keyed by path, e.g.
+# "items[2].amount") instead of stopping at the first. Bodies must be
+# parsed with parse_float=Decimal so money never goes through float.
+MONEY_QUANTUM = Decimal("0.01")
+DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+class Field:
+    """Declarative field spec; kind is str | text_id | bool | money | int | date | email | list."""
+    __slots__ = ("kind", "required", "min", "max", "max_length", "choices", "pattern", "item_schema")
+
+    def __init__(self, kind, required=True, min=None, max=None, max_length=None,
+                 choices=None, pattern=None, item_schema=None):
+        self.kind = kind
+        self.required = required
+        self.min = min
+        self.max = max
+        self.max_length = max_length
+        self.choices = frozenset(choices) if choices else None
+        self.pattern = re.compile(pattern) if pattern else None
+        self.item_schema = item_schema
+
+def _compile_field(field):
+    """Field -> check(value) returning (cleaned value, error message or None)."""
+    kind = field.kind
+    lo, hi = field.min, field.max
+    max_length, choices, pattern = field.max_length, field.choices, field.pattern
+
+    if kind in ("str", "text_id", "email"):
+        coerce_numbers = kind == "text_id"  # Account codes / invoice numbers may arrive as numbers
+        is_email = kind == "email"
+        def check(value):
+            if value.__class__ is not str:
+                if coerce_numbers and value.__class__ in (int, Decimal):
+                    value = str(value)
+                else:
+                    return None, "must be a string"
+            value = value.strip()
+            if not value:
+                return value, "must not be empty"
+            if max_length and len(value) > max_length:
+                return value, f"must be at most {max_length} characters"
+            if is_email:
+                value = value.lower()
+                if not EMAIL_RE.match(value):
+                    return value, "must be an email address"
+            if pattern and not pattern.match(value):
+                return value, "has an invalid format"
+            if choices and value not in choices:
+                return value, f"must be one of {sorted(choices)}"
+            return value, None
+    elif kind == "bool":
+        def check(value):
+            return value, None if value.__class__ is bool else "must be true or false"
+    elif kind in ("money", "int"):
+        whole = kind == "int"
+        def check(value):
+            cls = value.__class__
+            if cls is Decimal:
+                number = value
+            elif cls is int or cls is str:
+                try:
+                    number = Decimal(value.strip() if cls is str else value)
+                except ArithmeticError:
+                    return None, "must be a number"
+            else:
+                return None, "must be a number"  # Floats are rejected: parse with parse_float=Decimal
+            if not number.is_finite():
+                return None, "must be a finite number"
+            # Range first: it keeps huge values away from int() and quantize()
+            if lo is not None and number < lo:
+                return None, f"must be at least {lo}"
+            if hi is not None and number > hi:
+                return None, f"must be at most {hi}"
+            exponent = number.as_tuple().exponent
+            if whole:
+                if exponent < 0 and number != number.to_integral_value():
+                    return None, "must be a whole number"
+                number = int(number)
+            elif exponent < -2:
+                try:
+                    if number != number.quantize(MONEY_QUANTUM):
+                        return None, "must have at most 2 decimal places"
+                except ArithmeticError:  # More digits than the context precision
+                    return None, "has too many digits"
+            return number, None
+    elif kind == "date":
+        def check(value):
+            if value.__class__ is not str or not DATE_RE.match(value):
+                return value, "must be a date (YYYY-MM-DD)"
+            try:
+                datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                return value, "is not a valid date"
+            return value, None
+    elif kind == "list":
+        validate_item = field.item_schema
+        def check(value):
+            if value.__class__ is not list:
+                return None, "must be a list"
+            if lo is not None and len(value) < lo:
+                return value, f"must have at least {lo} entries"
+            if hi is not None and len(value) > hi:
+                return value, f"must have at most {hi} entries"
+            cleaned, nested = [], None
+            for i, entry in enumerate(value):
+                if entry.__class__ is not dict:
+                    cleaned.append(None)
+                    nested = nested or {}
+                    nested[f"[{i}]"] = "must be an object"
+                    continue
+                clean, errors = validate_item(entry)
+                cleaned.append(clean)
+                if errors:
+                    nested = nested or {}
+                    for key, message in errors.items():
+                        nested[f"[{i}].{key}"] = message
+            return cleaned, nested
+    else:
+        raise ValueError(f"Unknown field kind {kind!r}")
+    return check
+
+def compile_schema(schema, partial=False):
+    """
+    schema (name -> Field) -> validate(data) -> (cleaned dict, errors).
+    errors maps paths ("tin", "items[2].amount") to messages and is {} when
+    valid. Unknown keys are dropped; partial=True makes every field optional.
+    """
+    checks = tuple((name, field.required and not partial, _compile_field(field)) for name, field in schema.items())
+
+    def validate(data):
+        if data.__class__ is not dict:
+            return None, {"body": "must be an object"}
+        clean, errors = {}, {}
+        for name, required, check in checks:
+            if name in data:
+                value, error = check(data[name])
+                clean[name] = value
+                if error:
+                    if error.__class__ is dict:
+                        for key, message in error.items():
+                            errors[name + key] = message
+                    else:
+                        errors[name] = error
+            elif required:
+                errors[name] = "is required"
+        return clean, errors
+
+    validate.checks = {name: check for name, _, check in checks}
+    return validate
+
+def validate_field(validator, name, value):
+    """Validate one field of a compiled schema (JSON-Patch values); (cleaned, errors)."""
+    value, error = validator.checks[name](value)
+    if not error:
+        return value, {}
+    if error.__class__ is dict:
+        return value, {name + key: message for key, message in error.items()}
+    return value, {name: error}
+
+LINE_ITEM_SCHEMA = {
+    "particulars": Field("str", max_length=500),
+    "project_class": Field("text_id", max_length=100),
+    "account": Field("text_id", max_length=100),
+    "vatable": Field("bool"),
+    "amount": Field("money", min=Decimal("0.01"), max=Decimal("999999999999.99")),
+    "remarks": Field("str", required=False, max_length=1000),
+    "id": Field("text_id", required=False, max_length=64),  # Existing items keep their id on update
+}
+validate_line_item = compile_schema(LINE_ITEM_SCHEMA)
+
+INVOICE_SCHEMA = {
+    "company_name": Field("str", max_length=200),
+    "tin": Field("str", max_length=32, pattern=r"^[0-9A-Za-z-]+$"),
+    "invoice_number": Field("text_id", max_length=64),
+    "transaction_date": Field("date"),
+    "items": Field("list", min=1, max=500, item_schema=validate_line_item),
+    "payee": Field("email"),
+    "payee_account": Field("text_id", max_length=64),
+    "approver": Field("email"),
+    "remarks": Field("str", required=False, max_length=1000),
+    "file_key": Field("str", required=False, max_length=1024),
+    "file_name": Field("str", required=False, max_length=255),
+}
+validate_invoice = compile_schema(INVOICE_SCHEMA)
+
+INVOICE_UPDATE_SCHEMA = {
+    "company_name": INVOICE_SCHEMA["company_name"],
+    "tin": INVOICE_SCHEMA["tin"],
+    "transaction_date": INVOICE_SCHEMA["transaction_date"],
+    "items": Field("list", max=500, item_schema=validate_line_item),
+    "status": Field("str", choices=("Pending", "Approved", "Rejected")),
+}
+validate_invoice_update = compile_schema(INVOICE_UPDATE_SCHEMA, partial=True)
+
+# =========================================================
+# INVOICE CREATION (reference IDs, validation, batch writes)
+# =========================================================
+BATCH_WRITE_MAX_ITEMS = 25       # BatchWriteItem limit
+BATCH_GET_MAX_KEYS = 100         # BatchGetItem limit
+BATCH_MAX_ATTEMPTS = int(os.getenv("BATCH_MAX_ATTEMPTS", "6"))
+
+def reference_prefix(now=None):
+    now = now or datetime.utcnow()
+    return f"{now.month:02d}{now.year}"
+
+def _latest_reference_number(prefix):
+    """Highest "<prefix>-NNN" number already used (paginated scan, done once per month)."""
+    latest = 0
+    scan_kwargs = {
+        "ProjectionExpression": "reference_id",
+        "FilterExpression": Attr("reference_id").begins_with(f"{prefix}-"),
+    }
+    while True:
+        page = INVOICE_TABLE.scan(**scan_kwargs)
+        for ref in page.get("Items", []):
+            try:
+                latest = max(latest, int(ref["reference_id"].split("-")[1]))
+            except (IndexError, ValueError):
+                pass
+        if "LastEvaluatedKey" not in page:
+            return latest
+        scan_kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+def allocate_reference_ids(count, now=None):
+    """
+    Reserve `count` consecutive reference IDs ("MMYYYY-NNN") with one atomic
+    counter update. The month's counter is seeded from the existing invoices
+    the first time it is used.
+    """
+    prefix = reference_prefix(now)
+    for _ in range(2):
+        try:
+            resp = COUNTERS_TABLE.update_item(
+                Key={"prefix": prefix},
+                UpdateExpression="ADD last_number :n",
+                ConditionExpression="attribute_exists(#prefix)",
+                ExpressionAttributeNames={"#prefix": "prefix"},
+                ExpressionAttributeValues={":n": count},
+                ReturnValues="UPDATED_NEW",
+            )
+            last = int(resp["Attributes"]["last_number"])
+            return [f"{prefix}-{n:03d}" for n in range(last - count + 1, last + 1)]
+        except DYNAMODB_CLIENT.exceptions.ConditionalCheckFailedException:
+            try:
+                COUNTERS_TABLE.put_item(
+                    Item={"prefix": prefix, "last_number": _latest_reference_number(prefix)},
+                    ConditionExpression="attribute_not_exists(#prefix)",
+                    ExpressionAttributeNames={"#prefix": "prefix"},
+                )
+            except DYNAMODB_CLIENT.exceptions.ConditionalCheckFailedException:
+                pass  # Another container seeded it first
+    raise RuntimeError(f"Could not allocate reference IDs for {prefix}")
+
+def _backoff(attempt):
+    """Full-jitter exponential backoff for unprocessed batch items."""
+    time.sleep(random.uniform(0, min(0.05 * 2 ** attempt, 2.0)))
+
+def batch_write_all(table, items):
+    """
+    BatchWriteItem puts in chunks of 25, retrying UnprocessedItems with
+    jittered backoff. Returns the items that were still unprocessed.
+    """
+    failed = []
+    for start in range(0, len(items), BATCH_WRITE_MAX_ITEMS):
+        pending = {table.name: [{"PutRequest": {"Item": item}} for item in items[start:start + BATCH_WRITE_MAX_ITEMS]]}
+        for attempt in range(BATCH_MAX_ATTEMPTS):
+            pending = DYNAMODB.batch_write_item(RequestItems=pending).get("UnprocessedItems") or {}
+            if not pending:
+                break
+            _backoff(attempt)
+        failed.extend(r["PutRequest"]["Item"] for r in pending.get(table.name, []))
+    return failed
+
+def batch_get_items(table, key_name, values):
+    """key value -> item for the given values (deduplicated, chunked BatchGetItem)."""
+    keys = sorted(set(values))
+    found = {}
+    for start in range(0, len(keys), BATCH_GET_MAX_KEYS):
+        pending = {table.name: {"Keys": [{key_name: k} for k in keys[start:start + BATCH_GET_MAX_KEYS]]}}
+        for attempt in range(BATCH_MAX_ATTEMPTS):
+            resp = DYNAMODB.batch_get_item(RequestItems=pending)
+            for item in resp.get("Responses", {}).get(table.name, []):
+                found[item[key_name]] = item
+            pending = resp.get("UnprocessedKeys") or {}
+            if not pending:
+                break
+            _backoff(attempt)
+        else:
+            raise RuntimeError(f"{table.name} lookup throttled, please retry")
+    return found
+
+def _normalize_email(email):
+    return email.strip().lower() if isinstance(email, str) and email.strip() else None
+
+def batch_get_employees(emails):
+    """email -> Employees item for the given emails (deduplicated, chunked BatchGetItem)."""
+    return batch_get_items(EMPLOYEE_TABLE, "email", filter(None, map(_normalize_email, emails)))
+
+# -------- Referential validation --------
+# Every employee, account and project class an invoice points at is checked.
+# References are resolved from the cached reference data; only misses (e.g.
+# rows added since the last refresh) cost one BatchGetItem per table.
+ENCODER_ROLES = {r.strip() for r in os.getenv("ENCODER_ROLES", "").split(",") if r.strip()}  # Empty: any employee
+INACTIVE_EMPLOYEE_STATUSES = {"inactive", "disabled", "terminated"}
+
+def resolve_employees(emails):
+    """email -> employee for every known email among emails."""
+    wanted = set(filter(None, map(_normalize_email, emails)))
+    directory = cached_employee_directory()
+    found = {e: directory[e] for e in wanted if e in directory}
+    for email, employee in batch_get_employees(wanted - set(found)).items():
+        if "access_role" in employee:
+            employee["access_role"] = sorted(employee["access_role"])
+        found[email] = employee
+    return found
+
+def resolve_accounts(names):
+    """(known account names among names, every known project class)."""
+    accounts = cached_accounts()
+    known = {a["account_name"] for a in accounts if a.get("account_name")}
+    classes = {str(c) for a in accounts for key in ("project_class", "project_classes") for c in _as_list(a.get(key))}
+    wanted = {str(n) for n in names if n is not None}
+    for account in batch_get_items(ACCOUNTS_TABLE, "account_name", wanted - known).values():
+        known.add(account["account_name"])
+        classes.update(str(c) for key in ("project_class", "project_classes") for c in _as_list(account.get(key)))
+    return known & wanted, classes
+
+def _employee_problem(employee, email, label):
+    if employee is None:
+        return f"{label} {email} not found"
+    if str(employee.get("status", "")).lower() in INACTIVE_EMPLOYEE_STATUSES:
+        return f"{label} {email} is {employee['status']}"
+    return None
+
+def validate_invoice_references(invoices, encoder_email):
+    """
+    Check encoder, payee, approver and each item's account / project_class
+    for every invoice at once. Returns one errors dict per invoice ({} when
+    valid) plus the resolved employees (email -> item).
+    Accounts and project classes are only enforced once reference data
+    exists for them, so an empty Accounts table doesn't block every invoice.
+    """
+    invoices = [inv if isinstance(inv, dict) else {} for inv in invoices]
+    items_of = [inv.get("items") if isinstance(inv.get("items"), list) else [] for inv in invoices]
+    employees = resolve_employees(
+        [encoder_email] + [inv.get(f) for inv in invoices for f in ("payee", "approver")]
+    )
+    account_names, project_classes = resolve_accounts(
+        item.get("account") for items in items_of for item in items if isinstance(item, dict)
+    )
+    enforce_accounts = bool(account_names) or bool(cached_accounts())
+
+    encoder_email = _normalize_email(encoder_email)
+    encoder = employees.get(encoder_email)
+    encoder_error = _employee_problem(encoder, encoder_email, "Encoder")
+    if not encoder_error and ENCODER_ROLES and not ENCODER_ROLES & set(encoder.get("access_role", [])):
+        encoder_error = f"Encoder needs one of the roles {sorted(ENCODER_ROLES)}"
+
+    results = []
+    for inv, items in zip(invoices, items_of):
+        errors = {}
+        if encoder_error:
+            errors["encoder"] = encoder_error
+        for field in ("payee", "approver"):
+            if field in inv and not _normalize_email(inv[field]):
+                errors[field] = f"{field.capitalize()} must be an email address"
+        payee_email = _normalize_email(inv.get("payee"))
+        if payee_email:
+            problem = _employee_problem(employees.get(payee_email), payee_email, "Payee")
+            if problem:
+                errors["payee"] = problem
+        approver_email = _normalize_email(inv.get("approver"))
+        if approver_email:
+            approver = employees.get(approver_email)
+            problem = _employee_problem(approver, approver_email, "Approver")
+            if not problem and "approver" not in approver.get("access_role", []):
+                problem = f"Selected approver is not marked as an approver. Roles found: {list(approver.get('access_role', []))}"
+            if problem:
+                errors["approver"] = problem
+        for idx, item in enumerate(items):
+            if not isinstance(item, dict):
+                continue
+            if enforce_accounts and "account" in item and str(item["account"]) not in account_names:
+                errors[f"item_{idx}.account"] = f"Unknown account {item['account']}"
+            if project_classes and "project_class" in item and str(item["project_class"]) not in project_classes:
+                errors[f"item_{idx}.project_class"] = f"Unknown project class {item['project_class']}"
+        results.append(errors)
+    return results, employees
+
+# =========================================================
+# IDEMPOTENCY (Idempotency-Key header)
+# =========================================================
+# The first request with a key takes an IN_PROGRESS lock, runs, and stores
+# its response; retries with the same key and body replay that response.
+# 5xx responses release the key so the client can retry for real.
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "60"))  # > function timeout
+IDEMPOTENCY_MAX_KEY_LENGTH = 255
+IDEMPOTENCY_MAX_RESPONSE_BYTES = 350 * 1024  # DynamoDB items are capped at 400 KB
+
+def _json_or_text(raw):
+    raw = bytes(raw)
+    try:
+        return json.loads(raw, parse_float=Decimal)
+    except ValueError:
+        return raw.decode("utf-8", "replace")
+
+def _canonical_payload(event):
+    """
+    The parsed request as canonical JSON bytes. A retry of the same request
+    may use a new multipart boundary or reorder JSON keys, so the raw body
+    can't be compared: JSON is re-serialized with sorted keys, and multipart
+    is reduced to its form fields plus the SHA-256 of each file.
+    """
+    content_type = (get_header(event, "Content-Type") or "").lower()
+    try:
+        if content_type.startswith("multipart/form-data"):
+            fields, files = {}, []
+            for part in iter_multipart(event):
+                if part["filename"] is None:
+                    fields[part["name"]] = _json_or_text(part["content"])
+                else:
+                    files.append({"name": part["name"], "filename": part["filename"], "sha256": _sha256_hex(part["content"])})
+            payload = {"fields": fields, "files": files}
+        else:
+            body = _decode_event_body(event)
+            payload = json.loads(body, parse_float=Decimal) if body.strip() else None
+    except ValueError:
+        return _decode_event_body(event)  # Unparseable: the handler rejects it anyway
+    return json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")
+
+def _request_fingerprint(event):
+    method = event.get("httpMethod") or ""
+    path = event.get("path") or event.get("resource") or ""
+    return _sha256_hex(f"{method} {path}\n".encode("utf-8") + _canonical_payload(event))
+
+def begin_idempotent_request(event, scope, principal):
+    """
+    Claim the request's Idempotency-Key. Returns (record_key, response):
+      - (None, None)       no header: run normally without idempotency
+      - (record_key, None) claimed: run, then call complete_idempotent_request
+      - (None, response)   replay, in-progress (409) or key misuse (400/422)
+    """
+    key = (get_header(event, "Idempotency-Key") or "").strip()
+    if not key:
+        return None, None
+    if len(key) > IDEMPOTENCY_MAX_KEY_LENGTH:
+        return None, format_response(400, message="Invalid Idempotency-Key", errors={"Idempotency-Key": f"At most {IDEMPOTENCY_MAX_KEY_LENGTH} characters"})
+
+    record_key = f"{scope}#{(principal or '').lower()}#{key}"
+    fingerprint = _request_fingerprint(event)
+    now = int(time.time())
+    try:
+        IDEMPOTENCY_TABLE.put_item(
+            Item={
+                "idempotency_key": record_key,
+                "request_hash": fingerprint,
+                "state": "IN_PROGRESS",
+                "locked_until": now + IDEMPOTENCY_LOCK_SECONDS,
+                "expires_at": now + IDEMPOTENCY_TTL_SECONDS,
+            },
+            # An expired lock means the first attempt died mid-flight: take it over
+            ConditionExpression="attribute_not_exists(idempotency_key) OR (#state = :in_progress AND locked_until < :now)",
+            ExpressionAttributeNames={"#state": "state"},
+            ExpressionAttributeValues={":in_progress": "IN_PROGRESS", ":now": now},
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
+        )
+        return record_key, None
+    except DYNAMODB_CLIENT.exceptions.ConditionalCheckFailedException as e:
+        existing = condition_failure_item(e) or {}
+
+    if existing.get("request_hash") != fingerprint:
+        return None, format_response(422, message="Idempotency-Key was already used with a different request")
+    if existing.get("state") != "COMPLETED":
+        return None, format_response(409, message="A request with this Idempotency-Key is still in progress")
+
+    cached = existing["response"]
+    headers = dict(cached.get("headers") or {})
+    headers["Idempotent-Replayed"] = "true"
+    return None, {"statusCode": int(cached["statusCode"]), "headers": headers, "body": cached.get("body", "")}
+
+def complete_idempotent_request(record_key, response):
+    """Store the response for replays, or release the key after a server error."""
+    if record_key is None:
+        return response
+    body = response.get("body") or ""
+    if response.get("statusCode", 500) >= 500 or len(body.encode("utf-8")) > IDEMPOTENCY_MAX_RESPONSE_BYTES:
+        IDEMPOTENCY_TABLE.delete_item(Key={"idempotency_key": record_key})
+        return response
+    IDEMPOTENCY_TABLE.update_item(
+        Key={"idempotency_key": record_key},
+        UpdateExpression="SET #state = :completed, #response = :response REMOVE locked_until",
+        ExpressionAttributeNames={"#state": "state", "#response": "response"},
+        ExpressionAttributeValues={
+            ":completed": "COMPLETED",
+            ":response": {"statusCode": response["statusCode"], "headers": response.get("headers") or {}, "body": body},
+        },
+    )
+    return response
+
+def run_idempotent(event, scope, principal, handler):
+    """Run handler() at most once per Idempotency-Key (scoped to the caller)."""
+    record_key, response = begin_idempotent_request(event, scope, principal)
+    if response is not None:
+        return response
+    try:
+        response = handler()
+    except Exception:
+        if record_key is not None:
+            IDEMPOTENCY_TABLE.delete_item(Key={"idempotency_key": record_key})
+        raise
+    return complete_idempotent_request(record_key, response)
+
 # =========================================================
 # AUTH CONFIG (JWT + Refresh)
 # =========================================================
@@ -160,6 +1834,11 @@ JWT_SECRET = os.getenv("JWT_SECRET", "local-secret")  # 🔒 In prod: AWS Secret
 ACCESS_TOKEN_TTL_SECONDS = int(os.getenv("ACCESS_TOKEN_TTL_SECONDS", "86400"))         # 1 day
 REFRESH_TOKEN_TTL_SECONDS = int(os.getenv("REFRESH_TOKEN_TTL_SECONDS", "2592000"))   # 30 days
 REFRESH_TOKEN_PEPPER = os.getenv("REFRESH_TOKEN_PEPPER", "change-me")                # 🔒 Secrets Manager
+# "stateful" -> opaque token hashed in RefreshTokens, rotated per use
+# "stateless" -> signed JWT carrying the revocation epoch; one GetItem, no writes, per refresh
+REFRESH_TOKEN_MODE = os.getenv("REFRESH_TOKEN_MODE", "stateful").lower()
+REFRESH_TOKEN_SECRET = os.getenv("REFRESH_TOKEN_SECRET", JWT_SECRET)                  # 🔒 Secrets Manager
+REVOCATION_EPOCH_CACHE_TTL_SECONDS = int(os.getenv("REVOCATION_EPOCH_CACHE_TTL_SECONDS", "60"))  # Revocation lag, see below
 OTP_MAX_ATTEMPTS = int(os.getenv("OTP_MAX_ATTEMPTS", "5"))
 OTP_WINDOW_SECONDS = int(os.getenv("OTP_WINDOW_SECONDS", "900"))  # 15 min for rate limit window
 
@@ -174,33 +1853,192 @@ def hash_otp(otp: str, salt: str) -> str:
     """
     return _sha256_hex((REFRESH_TOKEN_PEPPER + ":" + salt + ":" + otp).encode())
 
-# -------- Access & Refresh issuing --------
-def issue_tokens(email: str):
-    """
-    Issue short-lived access token (JWT) + long-lived opaque refresh token.
-    Refresh token is stored as a hash in DynamoDB and rotated on use.
-    Returns: (access_token, refresh_token_combined, refresh_expires_at)
-    """
-    now = int(time.time())
-    
-    # === START: ADDED CODE ===
-    # Fetch the employee data to get the role
+# -------- Employee role cache (warm containers) --------
+EMPLOYEE_ROLE_CACHE_TTL_SECONDS = int(os.getenv("EMPLOYEE_ROLE_CACHE_TTL_SECONDS", "300"))
+_EMPLOYEE_ROLE_CACHE = {}  # email -> (role, cached_at)
+
+def get_employee_role(email: str) -> str:
+    """Return the employee's role, re-reading DynamoDB at most once per TTL."""
+    now = time.time()
+    cached = _EMPLOYEE_ROLE_CACHE.get(email)
+    if cached and now - cached[1] < EMPLOYEE_ROLE_CACHE_TTL_SECONDS:
+        return cached[0]
+
     employee = get_employee(email)
     # The role should be a string, default to "user" if not found
     role = employee.get("role", "user") if employee else "user"
-    # === END: ADDED CODE ===
+    _EMPLOYEE_ROLE_CACHE[email] = (role, now)
+    return role
 
-    # Access token (JWT)
+# -------- DynamoDB transactions --------
+def transaction_cancel_reasons(error):
+    """Return the per-item cancellation codes of a TransactionCanceledException."""
+    return [r.get("Code", "None") for r in error.response.get("CancellationReasons", [])]
+
+def transaction_cancel_item(error, index):
+    """
+    Old item of one TransactItems entry sent with
+    ReturnValuesOnConditionCheckFailure="ALL_OLD" (None if it didn't exist).
+    """
+    reasons = error.response.get("CancellationReasons", [])
+    raw = reasons[index].get("Item") if index < len(reasons) else None
+    if not raw:
+        return None
+    return {k: _TYPE_DESERIALIZER.deserialize(v) for k, v in raw.items()}
+
+def condition_failure_item(error):
+    """
+    Old item attached to a ConditionalCheckFailedException raised with
+    ReturnValuesOnConditionCheckFailure="ALL_OLD" (None if it didn't exist).
+    Error payloads skip the resource's deserializer, so values are decoded here.
+    """
+    raw = error.response.get("Item")
+    if not raw:
+        return None
+    return {k: _TYPE_DESERIALIZER.deserialize(v) for k, v in raw.items()}
+
+# -------- Revocation epochs (revoke-all-sessions) --------
+# One item per user in RefreshTokens under a reserved sort key. Stateless
+# refresh tokens carry the epoch they were issued under and a family id
+# (fid) shared by every token rotated from the same login; bumping the
+# epoch revokes every token issued before, and a family id listed in
+# revoked_families revokes that one session.
+#
+# Refreshes use the per-container copy of the item, re-read once it is
+# older than the cache TTL, so a warm container does no DynamoDB read per
+# refresh. A revoke therefore reaches other containers within the TTL
+# (capped at ACCESS_TOKEN_TTL_SECONDS). A token accepted in that window
+# carries the old epoch, so its replacement is refused after the next
+# re-read; the worst case for a revoked session is TTL + one access token
+# lifetime. Logins and revokes read or write the item directly.
+REVOCATION_EPOCH_TOKEN_ID = "#epoch"
+_REVOCATION_CACHE_TTL = min(REVOCATION_EPOCH_CACHE_TTL_SECONDS, ACCESS_TOKEN_TTL_SECONDS)
+_REVOCATION_EPOCH_CACHE = {}  # email -> (epoch, revoked family ids, fetched_at)
+
+def get_revocation_state(email: str, fresh: bool = False):
+    """
+    Return (epoch, revoked family ids) for the user. Cached reads may lag a
+    revoke by up to the cache TTL; fresh=True reads the item consistently.
+    """
+    now = time.time()
+    cached = _REVOCATION_EPOCH_CACHE.get(email)
+    if not fresh and cached and now - cached[2] < _REVOCATION_CACHE_TTL:
+        return cached[0], cached[1]
+
+    resp = REFRESH_TOKENS_TABLE.get_item(
+        Key={"email": email, "token_id": REVOCATION_EPOCH_TOKEN_ID},
+        ProjectionExpression="epoch, revoked_families",
+        ConsistentRead=True,
+    )
+    item = resp.get("Item") or {}
+    epoch, families = int(item.get("epoch", 0)), frozenset(item.get("revoked_families") or ())
+    _REVOCATION_EPOCH_CACHE[email] = (epoch, families, now)
+    return epoch, families
+
+def get_revocation_epoch(email: str, fresh: bool = False) -> int:
+    return get_revocation_state(email, fresh)[0]
+
+def revoke_session_family(email: str, family_id: str):
+    """
+    Revoke one session family (every token rotated from one login). The
+    set is cleared by the next revoke_all_sessions, whose epoch covers it.
+    """
+    resp = REFRESH_TOKENS_TABLE.update_item(
+        Key={"email": email, "token_id": REVOCATION_EPOCH_TOKEN_ID},
+        UpdateExpression="ADD revoked_families :fid SET updated_at = :now",
+        ExpressionAttributeValues={":fid": {family_id}, ":now": int(time.time())},
+        ReturnValues="ALL_NEW",
+    )
+    item = resp["Attributes"]
+    _REVOCATION_EPOCH_CACHE[email] = (
+        int(item.get("epoch", 0)), frozenset(item.get("revoked_families") or ()), time.time()
+    )
+
+def revoke_all_sessions(email: str) -> int:
+    """
+    Atomically bump the user's revocation epoch. Stateless refresh tokens issued
+    before are rejected from the next refresh on, in every container (see
+    above). Outstanding stateful tokens are marked rotated right away.
+    Returns the new epoch.
+    """
+    now = int(time.time())
+    resp = REFRESH_TOKENS_TABLE.update_item(
+        Key={"email": email, "token_id": REVOCATION_EPOCH_TOKEN_ID},
+        UpdateExpression="ADD epoch :one SET updated_at = :now REMOVE revoked_families",
+        ExpressionAttributeValues={":one": 1, ":now": now},
+        ReturnValues="UPDATED_NEW",
+    )
+    epoch = int(resp["Attributes"]["epoch"])
+
+    query_kwargs = {
+        "KeyConditionExpression": Key("email").eq(email),
+        "FilterExpression": Attr("rotated").eq(False) & Attr("expires_at").gt(now),
+        "ProjectionExpression": "token_id",
+    }
+    while True:
+        page = REFRESH_TOKENS_TABLE.query(**query_kwargs)
+        for item in page.get("Items", []):
+            REFRESH_TOKENS_TABLE.update_item(
+                Key={"email": email, "token_id": item["token_id"]},
+                UpdateExpression="SET rotated = :true, revoked_at = :now",
+                ExpressionAttributeValues={":true": True, ":now": now},
+            )
+        if "LastEvaluatedKey" not in page:
+            break
+        query_kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+    _REVOCATION_EPOCH_CACHE[email] = (epoch, frozenset(), time.time())
+    return epoch
+
+# -------- Access & Refresh issuing --------
+def _issue_access_token(email: str, now: int) -> str:
+    """Short-lived access token (JWT) carrying the cached employee role."""
     access_payload = {
         "email": email,
         "type": "access",
         "iat": now,
         "exp": now + ACCESS_TOKEN_TTL_SECONDS,
-        # === START: ADDED CODE ===
-        "role": role,
-        # === END: ADDED CODE ===
+        "role": get_employee_role(email),
+    }
+    return jwt.encode(access_payload, JWT_SECRET, algorithm="HS256")
+
+def _issue_stateless_refresh_token(email: str, now: int, epoch=None, family_id=None):
+    """
+    Signed refresh token: verified in memory, revocable via the user's epoch
+    or its family id. A login starts a new family; refreshes keep it.
+    """
+    refresh_expires_at = now + REFRESH_TOKEN_TTL_SECONDS
+    refresh_payload = {
+        "email": email,
+        "type": "refresh",
+        # Logins read the epoch fresh: a token minted under a stale one would be revoked later
+        "epoch": get_revocation_epoch(email, fresh=True) if epoch is None else epoch,
+        "fid": family_id or secrets.token_urlsafe(12),
+        "jti": secrets.token_urlsafe(12),
+        "iat": now,
+        "exp": refresh_expires_at,
     }
-    access_token = jwt.encode(access_payload, JWT_SECRET, algorithm="HS256")
+    return jwt.encode(refresh_payload, REFRESH_TOKEN_SECRET, algorithm="HS256"), refresh_expires_at
+
+def issue_tokens(email: str, transact_items=None):
+    """
+    Issue short-lived access token (JWT) + long-lived refresh token.
+    In "stateful" mode the refresh token is opaque, stored as a hash in
+    DynamoDB and rotated on use; in "stateless" mode it is a signed JWT.
+
+    If transact_items is given, they are written in a single TransactWriteItems
+    call (together with the refresh-token Put in stateful mode); a failed
+    condition raises TransactionCanceledException and no token is issued.
+    Returns: (access_token, refresh_token_combined, refresh_expires_at)
+    """
+    now = int(time.time())
+    access_token = _issue_access_token(email, now)
+
+    if REFRESH_TOKEN_MODE == "stateless":
+        refresh_token, refresh_expires_at = _issue_stateless_refresh_token(email, now)
+        if transact_items:
+            DYNAMODB_CLIENT.transact_write_items(TransactItems=list(transact_items))
+        return access_token, refresh_token, refresh_expires_at
 
     # Refresh token: opaque secret split into token_id + raw; only store hash of raw
     token_id = secrets.token_urlsafe(16)
@@ -208,60 +2046,138 @@ def issue_tokens(email: str):
     refresh_hash = _sha256_hex((REFRESH_TOKEN_PEPPER + ":" + refresh_raw).encode())
     refresh_expires_at = now + REFRESH_TOKEN_TTL_SECONDS
 
-    REFRESH_TOKENS_TABLE.put_item(Item={
+    refresh_item = {
         "email": email,
         "token_id": token_id,
         "hash": refresh_hash,
         "created_at": now,
         "expires_at": refresh_expires_at,
         "rotated": False,
-    })
+    }
+
+    if transact_items:
+        DYNAMODB_CLIENT.transact_write_items(TransactItems=list(transact_items) + [
+            {"Put": {"TableName": REFRESH_TOKENS_TABLE.name, "Item": refresh_item}},
+        ])
+    else:
+        REFRESH_TOKENS_TABLE.put_item(Item=refresh_item)
 
     combined_refresh = f"{token_id}.{refresh_raw}"
     return access_token, combined_refresh, refresh_expires_at
 
-def rotate_refresh_token(email: str, token_id: str):
-    """Mark a refresh token as rotated (one-time use)."""
-    try:
-        REFRESH_TOKENS_TABLE.update_item(
-            Key={"email": email, "token_id": token_id},
-            UpdateExpression="SET rotated = :r",
-            ExpressionAttributeValues={":r": True},
-        )
-    except Exception as e:
-        # best-effort; don't fail the auth flow if we can't mark it
-        print(f"rotate_refresh_token warning: {e}")
+def rotate_refresh_token(email: str, token_id: str, refresh_hash: str, now: int):
+    """
+    Build the TransactWriteItems Update that marks a refresh token as rotated
+    (one-time use). The condition folds every check verify_refresh_token used
+    to do after a GetItem: token exists, hash matches, not rotated, not expired.
+    """
+    return {
+        "Update": {
+            "TableName": REFRESH_TOKENS_TABLE.name,
+            "Key": {"email": email, "token_id": token_id},
+            "UpdateExpression": "SET rotated = :true, rotated_at = :now",
+            "ConditionExpression": (
+                "attribute_exists(token_id) AND #h = :hash "
+                "AND rotated = :false AND expires_at > :now"
+            ),
+            "ExpressionAttributeNames": {"#h": "hash"},
+            "ExpressionAttributeValues": {
+                ":hash": refresh_hash,
+                ":true": True,
+                ":false": False,
+                ":now": now,
+            },
+            "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+        }
+    }
+
+def _refresh_failure_reason(error, raw_hash, now):
+    """Map a cancelled rotation transaction to a precise failure reason."""
+    reasons = error.response.get("CancellationReasons", [])
+    if not reasons or reasons[0].get("Code") != "ConditionalCheckFailed":
+        codes = [r.get("Code", "None") for r in reasons]
+        return "conflict" if "TransactionConflict" in codes else "transaction_failed"
+
+    old = reasons[0].get("Item")
+    if not old:
+        return "not_found"
+    # Error payloads skip the resource's deserializer, so values are still typed
+    old = {k: _TYPE_DESERIALIZER.deserialize(v) for k, v in old.items()}
+    if not hmac.compare_digest(raw_hash, old.get("hash", "")):
+        return "invalid"
+    if old.get("rotated"):
+        return "reused"
+    if now >= int(old.get("expires_at", 0)):
+        return "expired"
+    return "invalid"
 
 def verify_refresh_token(email: str, combined: str):
     """
-    Verify and rotate refresh token.
+    Verify and rotate refresh token in a single TransactWriteItems call:
+    conditional rotate of the presented token + Put of the new one.
     combined format: "<token_id>.<raw>"
-    Returns (ok: bool, result: dict|None)
-      If ok: result = {"access_token": ..., "refresh_token": ...}
+    Returns (ok: bool, result: dict)
+      If ok:     result = {"access_token": ..., "refresh_token": ...}
+      If not ok: result = {"reason": "malformed" | "not_found" | "invalid" |
+                           "reused" | "expired" | "revoked" | "conflict" |
+                           "transaction_failed"}
     """
     if not combined or "." not in combined:
-        return False, None
+        return False, {"reason": "malformed"}
 
-    token_id, raw = combined.split(".", 1)
-    # Lookup stored token by (email, token_id)
-    resp = REFRESH_TOKENS_TABLE.get_item(Key={"email": email, "token_id": token_id})
-    item = resp.get("Item")
-    if not item:
-        return False, None
+    # Signed tokens (header.payload.signature) are accepted in either mode so
+    # switching REFRESH_TOKEN_MODE doesn't log everyone out.
+    if combined.count(".") == 2:
+        return verify_stateless_refresh_token(email, combined)
 
+    token_id, raw = combined.split(".", 1)
     now = int(time.time())
-    if now > int(item.get("expires_at", 0)):
-        return False, None
-    if item.get("rotated"):
-        return False, None
-
     expected = _sha256_hex((REFRESH_TOKEN_PEPPER + ":" + raw).encode())
-    if not hmac.compare_digest(expected, item["hash"]):
-        return False, None
 
-    # Rotate old and issue new pair
-    rotate_refresh_token(email, token_id)
-    new_access, new_refresh, _ = issue_tokens(email)
+    try:
+        new_access, new_refresh, _ = issue_tokens(
+            email, transact_items=[rotate_refresh_token(email, token_id, expected, now)]
+        )
+    except TransactionCanceledException as e:
+        reason = _refresh_failure_reason(e, expected, now)
+        print(f"verify_refresh_token rejected token {token_id}: {reason}")
+        return False, {"reason": reason}
+
+    return True, {"access_token": new_access, "refresh_token": new_refresh}
+
+def decode_stateless_refresh_token(email: str, token: str):
+    """Claims of a valid signed refresh token for email, or (None, reason)."""
+    try:
+        claims = jwt.decode(token, REFRESH_TOKEN_SECRET, algorithms=["HS256"])
+    except jwt.ExpiredSignatureError:
+        return None, "expired"
+    except jwt.InvalidTokenError:
+        return None, "invalid"
+    if claims.get("type") != "refresh" or claims.get("email") != email:
+        return None, "invalid"
+    return claims, None
+
+def verify_stateless_refresh_token(email: str, token: str):
+    """
+    Verify a signed refresh token in memory and issue a new pair in the same
+    family. The revocation state comes from the per-container cache, so a
+    warm refresh costs no DynamoDB read (see the revocation notes above).
+    Returns the same (ok, result) shape as verify_refresh_token.
+    """
+    claims, reason = decode_stateless_refresh_token(email, token)
+    if claims is None:
+        return False, {"reason": reason}
+
+    epoch, revoked_families = get_revocation_state(email)
+    if int(claims.get("epoch", -1)) < epoch or claims.get("fid") in revoked_families:
+        return False, {"reason": "revoked"}
+
+    now = int(time.time())
+    new_access = _issue_access_token(email, now)
+    # Keep the token's own epoch: if the cache was stale, the replacement is refused once it catches up
+    new_refresh, _ = _issue_stateless_refresh_token(
+        email, now, epoch=int(claims["epoch"]), family_id=claims.get("fid")
+    )
     return True, {"access_token": new_access, "refresh_token": new_refresh}
 
 # -------- Access token verification from API Gateway event --------
@@ -282,6 +2198,225 @@ def verify_jwt_from_event(event):
     except jwt.InvalidTokenError:
         return None, "Invalid token"
 
+# =========================================================
+# HANDLER PIPELINE (one normalized request, pluggable stages)
+# =========================================================
+# api_handler(*stages)(endpoint) turns endpoint(request) -> response into
+# a lambda_handler. The event is normalized once into a Request (headers
+# lowercased, body decoded/parsed on first use, typed param accessors), then
+# passed through the stages in order. A stage is stage(request, call_next)
+# and wraps everything after it, so auth, caching and error mapping are
+# written once here instead of in every handler. Under the timing stage each
+# later stage's own time is reported in a Server-Timing header.
+PIPELINE_TIMING_LOG = os.getenv("PIPELINE_TIMING_LOG", "false").lower() == "true"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "256"))
+
+class HttpError(Exception):
+    """Raised anywhere under an api_handler; map_errors turns it into the response."""
+
+    def __init__(self, status, message, errors=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.errors = errors
+
+def validation_error(field, message):
+    return HttpError(400, "Validation Error", {field: message})
+
+_UNPARSED = object()
+
+class Request:
+    """API Gateway proxy event, normalized once per invocation."""
+    __slots__ = ("event", "context", "method", "path", "headers", "query", "path_params",
+                 "principal", "timings", "_raw", "_body")
+
+    def __init__(self, event, context=None):
+        self.event = event
+        self.context = context
+        self.method = (event.get("httpMethod") or "").upper()
+        self.path = event.get("path") or ""
+        self.headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+        # Helpers that take the raw event (get_header, idempotency) see the same headers
+        event["headers"] = self.headers
+        self.query = event.get("queryStringParameters") or {}
+        self.path_params = event.get("pathParameters") or {}
+        self.principal = None   # JWT payload, set by authenticate
+        self.timings = None     # [(stage, seconds)], enabled by the timing stage
+        self._raw = None
+        self._body = _UNPARSED
+
+    def header(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    @property
+    def content_type(self):
+        return (self.headers.get("content-type") or "").split(";", 1)[0].strip().lower()
+
+    @property
+    def principal_email(self):
+        return ((self.principal or {}).get("email") or "").strip().lower()
+
+    @property
+    def body_bytes(self):
+        """Body decoded once (base64 when API Gateway encoded it)."""
+        if self._raw is None:
+            self._raw = _decode_event_body(self.event)
+        return self._raw
+
+    def json(self):
+        """JSON body parsed once (numbers as Decimal); {} when empty, 400 when malformed."""
+        if self._body is _UNPARSED:
+            raw = self.body_bytes
+            try:
+                self._body = json.loads(raw, parse_float=Decimal) if raw else {}
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                raise HttpError(400, "Invalid JSON body", {"body": str(e)})
+        return self._body
+
+    def path_param(self, name):
+        value = self.path_params.get(name)
+        if not value:
+            raise HttpError(400, f"{name} is required in path")
+        return value
+
+    def query_str(self, name, default=None):
+        value = (self.query.get(name) or "").strip()
+        return value or default
+
+    def query_int(self, name, default=None, min=None, max=None):
+        value = self.query.get(name)
+        if value in (None, ""):
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            raise validation_error(name, f"{name} must be an integer")
+        if (min is not None and value < min) or (max is not None and value > max):
+            raise validation_error(name, f"{name} must be between {min} and {max}")
+        return value
+
+    def query_list(self, name, default=()):
+        value = self.query.get(name)
+        if not value:
+            return list(default)
+        return [v.strip() for v in value.split(",") if v.strip()]
+
+# -------- Stages --------
+def timing(request, call_next):
+    """Per-stage self time as a Server-Timing header (and a log line if enabled)."""
+    request.timings = []
+    response = call_next(request)
+    # Recorded as stages return, innermost first; self time = own - next inner
+    spans = request.timings[::-1]
+    parts = []
+    for i, (name, seconds) in enumerate(spans):
+        inner = spans[i + 1][1] if i + 1 < len(spans) else 0.0
+        parts.append(f"{name};dur={(seconds - inner) * 1000:.2f}")
+    if parts:
+        response.setdefault("headers", {})["Server-Timing"] = ", ".join(parts)
+        if PIPELINE_TIMING_LOG:
+            print(f"{request.method} {request.path} {response.get('statusCode')} {', '.join(parts)}")
+    return response
+
+def map_errors(request, call_next):
+    """HttpError -> its response; anything else -> 500, as every handler used to do by hand."""
+    try:
+        return call_next(request)
+    except HttpError as e:
+        return format_response(e.status, message=e.message, errors=e.errors)
+    except Exception as e:
+        print(f"Unhandled error in {request.method} {request.path}: {e}")
+        return format_response(500, message="Internal Server Error", errors={"exception": str(e)})
+
+def authenticate(request, call_next):
+    payload, error = verify_jwt_from_event(request.event)
+    if error:
+        return format_response(401, message="Unauthorized", errors={"auth": error})
+    request.principal = payload
+    return call_next(request)
+
+def cache_control(value):
+    """Stage adding a Cache-Control header to 200 responses."""
+    def cache_control(request, call_next):
+        response = call_next(request)
+        if response.get("statusCode") == 200:
+            response["headers"].setdefault("Cache-Control", value)
+        return response
+    return cache_control
+
+def response_cache(ttl_seconds, per_principal=False, max_entries=RESPONSE_CACHE_MAX_ENTRIES, domains=()):
+    """
+    Stage memoizing 200 responses per container, keyed by method, path and
+    query (and caller when per_principal). Hits skip the endpoint and the
+    JSON encoding entirely. domains lists the generation counters the
+    response is built from; they are part of the key, so a bump misses the
+    cache just like it reloads the reference caches.
+    """
+    entries = {}  # key -> (expires_at, response); dicts keep insertion order for eviction
+    lock = threading.Lock()
+
+    def response_cache(request, call_next):
+        key = (request.method, request.path, tuple(sorted(request.query.items())),
+               request.principal_email if per_principal else None,
+               tuple(current_generation(domain) for domain in domains))
+        now = time.time()
+        with lock:
+            hit = entries.get(key)
+        if hit and hit[0] > now:
+            return {**hit[1], "headers": dict(hit[1]["headers"])}
+        response = call_next(request)
+        if response.get("statusCode") == 200:
+            with lock:
+                entries.pop(key, None)
+                entries[key] = (now + ttl_seconds, {**response, "headers": dict(response["headers"])})
+                while len(entries) > max_entries:
+                    del entries[next(iter(entries))]
+        return response
+    return response_cache
+
+def idempotent(scope):
+    """Stage replaying the first response per Idempotency-Key (see run_idempotent)."""
+    def idempotent(request, call_next):
+        return run_idempotent(request.event, scope, request.principal_email, lambda: call_next(request))
+    return idempotent
+
+DEFAULT_STAGES = (timing, map_errors, authenticate)
+
+def _link(stage, call_next):
+    name = stage.__name__
+    def run(request):
+        if request.timings is None:
+            return stage(request, call_next)
+        started = time.perf_counter()
+        try:
+            return stage(request, call_next)
+        finally:
+            request.timings.append((name, time.perf_counter() - started))
+    return run
+
+def api_handler(*stages):
+    """
+    endpoint(request) -> lambda_handler(event, context), used as
+    lambda_handler = api_handler(...)(endpoint). With no stages,
+    DEFAULT_STAGES (timing, error mapping, JWT auth) apply. The chain is
+    composed once at import; the endpoint is timed under its own name.
+    """
+    stages = stages or DEFAULT_STAGES
+
+    def decorate(endpoint):
+        def innermost(request, call_next):
+            return endpoint(request)
+        innermost.__name__ = endpoint.__name__
+        chain = _link(innermost, None)
+        for stage in reversed(stages):
+            chain = _link(stage, chain)
+
+        def lambda_handler(event, context):
+            return chain(Request(event, context))
+        lambda_handler.__doc__ = endpoint.__doc__
+        return lambda_handler
+    return decorate
+
 # =========================================================
 # (Optional) COGNITO HELPERS — ignore if using custom auth
 # =========================================================
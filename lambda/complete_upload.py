@@ -0,0 +1,40 @@
+import json
+from common import (
+    format_response, verify_jwt_from_event, complete_presigned_upload, ATTACHMENT_PREFIX
+)
+
+def lambda_handler(event, context):
+    """
+    Completes a presigned multipart upload started by POST /invoices/uploads.
+
+    Body:
+        - key, upload_id (required)
+        - parts (required): [{"part_number": 1, "etag": "..."}, ...]
+    """
+    payload, error = verify_jwt_from_event(event)
+    if error:
+        return format_response(401, message="Unauthorized", errors={"auth": error})
+
+    try:
+        try:
+            body = json.loads(event.get("body") or "{}")
+        except json.JSONDecodeError:
+            return format_response(400, message="Invalid JSON body")
+
+        key = body.get("key") or ""
+        upload_id = body.get("upload_id")
+        parts = body.get("parts")
+
+        if not key.startswith(ATTACHMENT_PREFIX) or not upload_id or not isinstance(parts, list) or not parts:
+            return format_response(400, message="Validation Error", errors={"body": "key, upload_id and parts are required"})
+        if any(not isinstance(p, dict) or "part_number" not in p or "etag" not in p for p in parts):
+            return format_response(400, message="Validation Error", errors={"parts": "Each part needs part_number and etag"})
+
+        try:
+            complete_presigned_upload(key, upload_id, parts)
+        except ValueError as e:
+            return format_response(400, message="Validation Error", errors={"size": str(e)})
+        return format_response(200, message="Upload completed successfully", data={"key": key})
+
+    except Exception as e:
+        return format_response(500, message="Internal Server Error", errors={"exception": str(e)})
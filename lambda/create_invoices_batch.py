@@ -0,0 +1,184 @@
+import os
+import json
+from datetime import datetime
+from decimal import Decimal
+from common import (
+    INVOICE_TABLE, LINE_ITEMS_TABLE, ATTACHMENT_PREFIX, INVOICE_ITEMS_LAYOUT, ITEMS_LAYOUT_COLLECTION,
+    validate_invoice, format_response, verify_jwt_from_event,
+    cached_employee, validate_invoice_references, allocate_reference_ids, batch_write_all,
+    claim_attachment_reference, release_attachment, attachment_previews, backfill_invoice_previews, to_line_item_rows, from_line_item_row, assign_item_ids,
+    run_idempotent
+)
+
+BATCH_CREATE_MAX_INVOICES = int(os.getenv("BATCH_CREATE_MAX_INVOICES", "100"))
+
+def check_invoice(body):
+    """Schema-check one invoice payload: (cleaned, errors); references are checked in bulk."""
+    clean, errors = validate_invoice(body)
+    file_key = clean.get("file_key") if clean else None
+    if file_key and not file_key.startswith(ATTACHMENT_PREFIX):
+        errors["file_key"] = "Invalid attachment key"
+    return clean, errors
+
+def build_invoice(reference_id, body, encoder_email, employees, encoding_date):
+    invoice = {
+        "reference_id": reference_id,
+        "company_name": body["company_name"],
+        "tin": body["tin"],
+        "invoice_number": body["invoice_number"],
+        "transaction_date": body["transaction_date"],
+        "items": assign_item_ids(body["items"]),
+        "encoder": encoder_email,
+        "payee": body["payee"],
+        "payee_account": body["payee_account"],
+        "approver": employees[body["approver"]]["email"],
+        "encoding_date": encoding_date,
+        "status": "Pending",
+        "remarks": body.get("remarks", ""),
+        "version": 1
+    }
+    if body.get("file_key"):
+        invoice["file_key"] = body["file_key"]
+        invoice["file_name"] = body.get("file_name")
+        previews = attachment_previews(body["file_key"])
+        if previews:
+            invoice["previews"] = previews
+    return invoice
+
+def lambda_handler(event, context):
+    """
+    Creates up to BATCH_CREATE_MAX_INVOICES invoices in one request:
+    {"invoices": [{...same fields as POST /invoices...}]}
+
+    Every referenced employee and account is resolved once for the whole
+    batch (cached reference data, one BatchGetItem for misses), reference IDs
+    are reserved as one contiguous block, and invoices are written with
+    chunked BatchWriteItem. Each invoice gets its own result; invalid ones
+    are reported without blocking the rest. Attachments must be uploaded
+    first (POST /invoices/uploads) and referenced by file_key.
+    An Idempotency-Key header makes retries replay the first response.
+    """
+    payload, error = verify_jwt_from_event(event)
+    if error:
+        return format_response(401, message="Unauthorized", errors={"auth": error})
+
+    try:
+        return run_idempotent(event, "create_invoices_batch", payload.get("email"), lambda: create_invoices(event, payload))
+    except Exception as e:
+        return format_response(500, message="Internal Server Error", errors={"exception": str(e)})
+
+def create_invoices(event, payload):
+    try:
+        try:
+            body = json.loads(event.get("body") or "{}", parse_float=Decimal)
+        except json.JSONDecodeError as e:
+            return format_response(400, message="Bad Request", errors={"body": "Failed to parse JSON from request body: " + str(e)})
+
+        invoices = body.get("invoices") if isinstance(body, dict) else None
+        if not isinstance(invoices, list) or not invoices:
+            return format_response(400, message="Validation Error", errors={"invoices": "Provide a non-empty 'invoices' list"})
+        if len(invoices) > BATCH_CREATE_MAX_INVOICES:
+            return format_response(400, message="Validation Error", errors={"invoices": f"At most {BATCH_CREATE_MAX_INVOICES} invoices per request"})
+
+        user_email = payload.get("email")
+        if not user_email:
+            return format_response(401, message="Missing email in token payload")
+        encoder = cached_employee(user_email)
+        if not encoder:
+            return format_response(403, message="Employee record not found for the logged-in user")
+
+        # Schema-checked first, so references are resolved from cleaned values
+        checked = [check_invoice(inv) for inv in invoices]
+        invoices = [clean if clean is not None else {} for clean, _ in checked]
+        # One resolution of every employee/account referenced by the whole batch
+        reference_errors, employees = validate_invoice_references(invoices, encoder.get("email"))
+
+        results = [None] * len(invoices)
+        valid = []
+        try:
+            for idx, inv in enumerate(invoices):
+                errors = {**checked[idx][1], **reference_errors[idx]}
+                # Each valid invoice claims its attachment reference before any write
+                # (see claim_attachment_reference); failed writes give it back below
+                file_key = inv.get("file_key") if not errors else None
+                if file_key and not claim_attachment_reference(file_key):
+                    errors["file_key"] = "Attachment has not been uploaded or exceeds the size limit"
+                if errors:
+                    results[idx] = {"index": idx, "status": "invalid", "errors": errors}
+                else:
+                    valid.append(idx)
+        except Exception:
+            release_claims(invoices, valid)  # Claims taken before the failure
+            raise
+
+        if not valid:
+            return format_response(400, message="Validation Error", data={"results": results})
+
+        return write_invoices(invoices, valid, results, encoder.get("email"), employees)
+
+    except Exception as e:
+        return format_response(500, message="Internal Server Error", errors={"exception": str(e)})
+
+def release_claims(invoices, indices):
+    """Give back the attachment references claimed for invoices[indices]."""
+    for idx in indices:
+        file_key = invoices[idx].get("file_key")
+        if not file_key:
+            continue
+        try:
+            release_attachment(file_key)
+        except Exception as e:
+            # Keep releasing the rest; the orphan sweep reports what is left
+            print(f"release_attachment warning for {file_key}: {e}")
+
+def write_invoices(invoices, valid, results, encoder_email, employees):
+    """Allocate reference IDs and batch-write the valid invoices; fills results."""
+    try:
+        # ✅ One counter update for the whole block of reference IDs
+        reference_ids = allocate_reference_ids(len(valid))
+        encoding_date = datetime.utcnow().isoformat()
+        records = {
+            idx: build_invoice(ref_id, invoices[idx], encoder_email, employees, encoding_date)
+            for idx, ref_id in zip(valid, reference_ids)
+        }
+
+        failed_refs = set()
+        if INVOICE_ITEMS_LAYOUT == ITEMS_LAYOUT_COLLECTION:
+            # Rows first, headers last: a failed header never points at missing items
+            rows = []
+            for record in records.values():
+                record_rows = to_line_item_rows(record["reference_id"], record["items"])
+                record["items"] = [from_line_item_row(r) for r in record_rows]
+                rows.extend(record_rows)
+            failed_refs |= {row["reference_id"] for row in batch_write_all(LINE_ITEMS_TABLE, rows)}
+            headers = [
+                {**{k: v for k, v in r.items() if k != "items"}, "items_layout": ITEMS_LAYOUT_COLLECTION, "item_count": len(r["items"])}
+                for r in records.values() if r["reference_id"] not in failed_refs
+            ]
+        else:
+            headers = list(records.values())
+    except Exception:
+        release_claims(invoices, valid)  # No header written yet: every claim goes back
+        raise
+
+    # Unprocessed headers are definite failures; their references are released below
+    failed_refs |= {h["reference_id"] for h in batch_write_all(INVOICE_TABLE, headers)}
+
+    created = 0
+    for idx, record in records.items():
+        if record["reference_id"] in failed_refs:
+            if record.get("file_key"):
+                release_attachment(record["file_key"])
+            results[idx] = {"index": idx, "status": "failed", "errors": {"write": "Throttled, please retry this invoice"}}
+            continue
+        if record.get("file_key") and not record.get("previews"):
+            backfill_invoice_previews(record["reference_id"], record["file_key"])
+        results[idx] = {"index": idx, "status": "created", "reference_id": record["reference_id"]}
+        created += 1
+
+    status = 201 if created == len(invoices) else 207
+    return format_response(
+        status,
+        message=f"Created {created} of {len(invoices)} invoices",
+        data={"created": created, "results": results}
+    )
@@ -0,0 +1,55 @@
+import json
+from common import (
+    format_response, verify_jwt_from_event, presign_upload, new_attachment_key,
+    MAX_ATTACHMENT_BYTES, SHA256_HEX_RE
+)
+
+def lambda_handler(event, context):
+    """
+    Returns presigned URL(s) so the client can upload an invoice attachment
+    straight to S3. Pass the returned "key" as "file_key" to POST /invoices.
+
+    Body:
+        - filename (required)
+        - size (required): file size in bytes
+        - content_type (optional)
+        - sha256 (optional): hex digest; enables dedup ("method": "EXISTS"
+          means the file is already stored and no upload is needed)
+    """
+    payload, error = verify_jwt_from_event(event)
+    if error:
+        return format_response(401, message="Unauthorized", errors={"auth": error})
+
+    try:
+        try:
+            body = json.loads(event.get("body") or "{}")
+        except json.JSONDecodeError:
+            return format_response(400, message="Invalid JSON body")
+
+        filename = (body.get("filename") or "").strip()
+        content_type = body.get("content_type")
+        sha256 = (body.get("sha256") or "").strip().lower() or None
+        try:
+            size = int(body.get("size"))
+        except (TypeError, ValueError):
+            size = None
+
+        if not filename or size is None:
+            return format_response(
+                400,
+                message="Validation Error",
+                errors={"filename": "Required" if not filename else None,
+                        "size": "Required (bytes)" if size is None else None}
+            )
+        if size <= 0 or size > MAX_ATTACHMENT_BYTES:
+            return format_response(400, message="Validation Error", errors={"size": f"Must be between 1 and {MAX_ATTACHMENT_BYTES} bytes"})
+
+        if sha256 and not SHA256_HEX_RE.match(sha256):
+            return format_response(400, message="Validation Error", errors={"sha256": "Must be a 64-character hex digest"})
+
+        upload = presign_upload(new_attachment_key(filename), size, content_type, sha256=sha256)
+        upload["file_name"] = filename
+        return format_response(201, message="Upload URL created successfully", data=upload)
+
+    except Exception as e:
+        return format_response(500, message="Internal Server Error", errors={"exception": str(e)})
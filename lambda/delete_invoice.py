@@ -1,4 +1,7 @@
-from common import format_response, INVOICE_TABLE, verify_jwt_from_event
+from common import (
+    format_response, INVOICE_TABLE, verify_jwt_from_event, attachment_key_of, release_attachment,
+    uses_item_collection, delete_line_items
+)
 
 def lambda_handler(event, context):
     payload, error = verify_jwt_from_event(event)
@@ -10,7 +13,22 @@ def lambda_handler(event, context):
         if not reference_id:
             return format_response(400, message="Missing reference_id in path")
 
-        INVOICE_TABLE.delete_item(Key={"reference_id": reference_id})
+        deleted = INVOICE_TABLE.delete_item(
+            Key={"reference_id": reference_id},
+            ReturnValues="ALL_OLD",
+        ).get("Attributes")
+
+        if uses_item_collection(deleted):
+            delete_line_items(reference_id)
+
+        file_key = attachment_key_of(deleted) if deleted else None
+        if file_key:
+            try:
+                release_attachment(file_key)
+            except Exception as e:
+                # The invoice is gone either way; do not fail the delete over it
+                print(f"release_attachment warning for {file_key}: {e}")
+
         return format_response(200, message="Invoice deleted successfully")
 
     except Exception as e:
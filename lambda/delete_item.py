@@ -1,39 +1,137 @@
-from common import format_response, INVOICE_TABLE, verify_jwt_from_event
+from decimal import Decimal, InvalidOperation
+from common import (
+    format_response, INVOICE_TABLE, LINE_ITEMS_TABLE, DYNAMODB_CLIENT, api_handler,
+    TransactionCanceledException, transaction_cancel_reasons, transaction_cancel_item, line_item_key, uses_item_collection,
+    items_generation_condition,
+    INVOICE_ITEMS_LAYOUT, ITEMS_LAYOUT_COLLECTION, VERSION_NAMES
+)
 
-def lambda_handler(event, context):
-    payload, error = verify_jwt_from_event(event)
-    if error:
-        return format_response(401, message=error)
+DELETE_ITEM_MAX_ATTEMPTS = 3
 
+def _id_values(item_id):
+    """Path params are strings, but older items may carry numeric ids."""
+    values = {":sid": item_id, ":nid": item_id}
     try:
-        path_params = event.get("pathParameters", {}) or {}
-        reference_id = path_params.get("reference_id")
-        item_id = path_params.get("item_id")
+        number = Decimal(item_id)
+    except InvalidOperation:
+        return values
+    if number.is_finite():  # "NaN"/"Infinity" parse but DynamoDB can't store them
+        values[":nid"] = number
+    return values
 
-        if not reference_id or not item_id:
-            return format_response(400, message="reference_id and item_id are required in path")
+def _delete_from_collection(reference_id, item_id):
+    """
+    Delete one row of a collection-layout invoice (+ item_count) in one call,
+    from the header's current items generation.
+    Returns "deleted", "item_not_found", "not_collection" or "conflict".
+    """
+    generation = None
+    for _ in range(DELETE_ITEM_MAX_ATTEMPTS):
+        generation_expr, generation_values = items_generation_condition(generation)
+        try:
+            DYNAMODB_CLIENT.transact_write_items(TransactItems=[
+                {"Update": {
+                    "TableName": INVOICE_TABLE.name,
+                    "Key": {"reference_id": reference_id},
+                    "UpdateExpression": "ADD item_count :minus_one, #version :one",
+                    "ConditionExpression": f"items_layout = :collection AND {generation_expr}",
+                    "ExpressionAttributeNames": VERSION_NAMES,
+                    "ExpressionAttributeValues": {
+                        ":minus_one": -1, ":one": 1, ":collection": ITEMS_LAYOUT_COLLECTION, **generation_values
+                    },
+                    "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+                }},
+                {"Delete": {
+                    "TableName": LINE_ITEMS_TABLE.name,
+                    "Key": {"reference_id": reference_id, "item_key": line_item_key(item_id, generation)},
+                    "ConditionExpression": "attribute_exists(item_key)",
+                }},
+            ])
+            return "deleted"
+        except TransactionCanceledException as e:
+            reasons = transaction_cancel_reasons(e)
+            if reasons[:1] == ["ConditionalCheckFailed"]:
+                header = transaction_cancel_item(e, 0)
+                if not uses_item_collection(header):
+                    return "not_collection"
+                generation = header.get("items_generation")  # Rewritten since; retry in the live generation
+                continue
+            if reasons[1:2] == ["ConditionalCheckFailed"]:
+                return "item_not_found"
+            raise
+    return "conflict"
 
-        invoice = INVOICE_TABLE.get_item(Key={"reference_id": reference_id})
-        if "Item" not in invoice:
-            return format_response(404, message="Invoice not found")
+def _find_index(reference_id, item_id):
+    """
+    Return (found_invoice, index) — index is None if the item isn't there.
+    found_invoice is ITEMS_LAYOUT_COLLECTION for collection-layout invoices.
+    """
+    resp = INVOICE_TABLE.get_item(
+        Key={"reference_id": reference_id},
+        ProjectionExpression="#items, items_layout",
+        ExpressionAttributeNames={"#items": "items"},
+    )
+    if "Item" not in resp:
+        return False, None
+    if uses_item_collection(resp["Item"]):
+        return ITEMS_LAYOUT_COLLECTION, None
+    for idx, item in enumerate(resp["Item"].get("items", [])):
+        if str(item.get("id")) == item_id:
+            return True, idx
+    return True, None
 
-        items = invoice["Item"].get("items", [])
-        filtered_items = [i for i in items if str(i.get("id")) != item_id]
+def delete_item(request):
+    """
+    Removes a line item by index with a condition on its id, so a concurrent
+    edit that shifts the list can't make us delete the wrong item.
 
-        if len(filtered_items) == len(items):
+    Query parameters:
+        - index (optional): position hint from the client's copy of the
+          invoice; when it is still correct the delete is a single write.
+    """
+    reference_id = request.path_param("reference_id")
+    item_id = request.path_param("item_id")
+
+    index = request.query_int("index")
+    if index is not None and index < 0:
+        index = None
+
+    if INVOICE_ITEMS_LAYOUT == ITEMS_LAYOUT_COLLECTION:
+        outcome = _delete_from_collection(reference_id, item_id)
+        if outcome == "deleted":
+            return format_response(200, message=f"Item {item_id} deleted successfully")
+        if outcome == "item_not_found":
             return format_response(404, message="Item not found in invoice")
+        if outcome == "conflict":
+            return format_response(409, message="Invoice items changed concurrently, please retry")
+
+    for _ in range(DELETE_ITEM_MAX_ATTEMPTS):
+        if index is None:
+            found, index = _find_index(reference_id, item_id)
+            if not found:
+                return format_response(404, message="Invoice not found")
+            if found == ITEMS_LAYOUT_COLLECTION:
+                outcome = _delete_from_collection(reference_id, item_id)
+                if outcome == "deleted":
+                    return format_response(200, message=f"Item {item_id} deleted successfully")
+                if outcome == "conflict":
+                    return format_response(409, message="Invoice items changed concurrently, please retry")
+                return format_response(404, message="Item not found in invoice")
+            if index is None:
+                return format_response(404, message="Item not found in invoice")
 
-        INVOICE_TABLE.update_item(
-            Key={"reference_id": reference_id},
-            UpdateExpression="SET items = :items",
-            ExpressionAttributeValues={":items": filtered_items}
-        )
+        try:
+            INVOICE_TABLE.update_item(
+                Key={"reference_id": reference_id},
+                UpdateExpression=f"REMOVE #items[{index}] ADD #version :one",
+                ConditionExpression=f"#items[{index}].id IN (:sid, :nid)",
+                ExpressionAttributeNames={"#items": "items", **VERSION_NAMES},
+                ExpressionAttributeValues={**_id_values(item_id), ":one": 1},
+            )
+            return format_response(200, message=f"Item {item_id} deleted successfully")
+        except DYNAMODB_CLIENT.exceptions.ConditionalCheckFailedException:
+            index = None  # List changed under us, stale hint, or not embedded — re-locate and retry
 
-        return format_response(200, message=f"Item {item_id} deleted successfully")
+    return format_response(409, message="Invoice items changed concurrently, please retry")
 
-    except Exception as e:
-        return format_response(
-            500,
-            message="Internal Server Error",
-            errors={"exception": str(e)}
-        )
+lambda_handler = api_handler()(delete_item)
@@ -1,31 +1,24 @@
-from common import format_response, INVOICE_TABLE, decimal_to_float, verify_jwt_from_event
+from common import (
+    format_response, INVOICE_TABLE, decimal_to_float, with_attachment_url, with_line_items, api_handler,
+    etag_of, with_int_version
+)
 
-def lambda_handler(event, context):
-    payload, error = verify_jwt_from_event(event)
-    if error:
-        return format_response(401, message=error)
+def get_invoice(request):
+    """Returns the invoice with its version as ETag, ready to echo back as If-Match."""
+    reference_id = request.path_param("reference_id")
 
-    try:
-        path_params = event.get("pathParameters", {}) or {}
-        reference_id = path_params.get("reference_id")
+    response = INVOICE_TABLE.get_item(Key={"reference_id": reference_id})
 
-        if not reference_id:
-            return format_response(400, message="reference_id is required in path")
-
-        response = INVOICE_TABLE.get_item(Key={"reference_id": reference_id})
-
-        if "Item" in response:
-            return format_response(
-                200,
-                message="Invoice retrieved successfully",
-                data=decimal_to_float(response["Item"])
-            )
+    if "Item" in response:
+        invoice = with_line_items(response["Item"])
+        result = format_response(
+            200,
+            message="Invoice retrieved successfully",
+            data=with_int_version(with_attachment_url(decimal_to_float(invoice)))
+        )
+        result["headers"]["ETag"] = etag_of(invoice)
+        return result
 
-        return format_response(404, message="Invoice not found")
+    return format_response(404, message="Invoice not found")
 
-    except Exception as e:
-        return format_response(
-            500,
-            message="Internal Server Error",
-            errors={"exception": str(e)}
-        )
+lambda_handler = api_handler()(get_invoice)
@@ -1,43 +1,80 @@
 import json
-from common import EMPLOYEE_TABLE, format_response, verify_jwt_from_event
+import base64
+import bisect
+from common import (
+    format_response, cached_employee_directory, api_handler, validation_error,
+    sorted_employees, sorted_employee_keys, employee_search_index, employee_sort_key
+)
 
-def lambda_handler(event, context):
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(employee):
+    return base64.urlsafe_b64encode(json.dumps(employee_sort_key(employee)).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    """Sort key of the last row served; anything else is rejected before it reaches bisect."""
+    try:
+        after = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    # Must compare like employee_sort_key: (last_name, first_name, email), all strings
+    if not isinstance(after, list) or len(after) != 3 or not all(isinstance(part, str) for part in after):
+        raise ValueError("Invalid cursor")
+    return tuple(after)
+
+def project(employee, fields):
+    if not fields:
+        return employee
+    return {k: employee[k] for k in fields if k in employee}
+
+def list_employees(request):
     """
-    Lambda function to list all employees from the DynamoDB table.
+    Lambda function to list employees from the directory cache.
+
+    Query parameters (all optional; without them every employee is returned):
+      q       prefix of first name, last name, full name or email
+      fields  comma-separated attributes to return (email is always included)
+      limit   page size (max 500); the response then carries next_cursor
+      cursor  next_cursor of the previous page
     """
-    # Verify the JWT token to ensure the user is authenticated.
-    payload, error = verify_jwt_from_event(event)
-    if error:
-        return format_response(401, message="Unauthorized", errors={"auth": error})
+    fields = None
+    if request.query_list("fields"):
+        fields = ["email"] + [f for f in request.query_list("fields") if f != "email"]
 
-    try:
-        # Perform a scan to get all items. Note: for very large tables,
-        # a query with pagination is more efficient and cost-effective.
-        response = EMPLOYEE_TABLE.scan()
-        employees = response.get('Items', [])
-
-        # Process each employee item to handle data types.
-        for employee in employees:
-            # DynamoDB's String Set (SS) is returned as a Python 'set' object,
-            # which is not JSON serializable. We must convert it to a list.
-            if 'access_role' in employee:
-                employee['access_role'] = list(employee['access_role'])
-            
-            # The is_approver logic is no longer needed, as the 'access_role'
-            # attribute is the single source of truth for an employee's roles.
-            # The frontend can check for the presence of the 'approver' role.
-        return format_response(
-            200,
-            message="Employees fetched successfully",
-            data={
-                "employees": employees
-            }
-        )
-
-    except Exception as e:
-        print(e)
-        return format_response(
-            500,
-            message="An unexpected error occurred",
-            errors={"internal": str(e)}
-        )
+    q = request.query_str("q")
+    cursor = request.query_str("cursor")
+    limit = request.query_int("limit", default=50 if cursor else None, min=1, max=MAX_PAGE_SIZE)
+
+    # ✅ Served from the per-container reference cache. access_role is
+    # already a list there (DynamoDB String Sets aren't JSON serializable);
+    # the frontend checks it for the 'approver' role.
+    employees, keys = sorted_employees(), sorted_employee_keys()
+    if q:
+        directory = cached_employee_directory()
+        # Search returns emails in directory order, so pages stay sorted
+        employees = [directory[email] for email in employee_search_index().search(q)]
+        keys = [employee_sort_key(e) for e in employees]
+
+    if cursor:
+        try:
+            after = decode_cursor(cursor)
+        except ValueError as e:
+            raise validation_error("cursor", str(e))
+        # Resume after the last row served, even if employees were added since
+        employees = employees[bisect.bisect_right(keys, after):]
+
+    next_cursor = None
+    if limit is not None and len(employees) > limit:
+        employees = employees[:limit]
+        next_cursor = encode_cursor(employees[-1])
+
+    return format_response(
+        200,
+        message="Employees fetched successfully",
+        data={
+            "employees": [project(e, fields) for e in employees],
+            "next_cursor": next_cursor
+        }
+    )
+
+lambda_handler = api_handler()(list_employees)
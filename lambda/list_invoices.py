@@ -1,22 +1,18 @@
 import json
-from common import format_response, INVOICE_TABLE, decimal_to_float, verify_jwt_from_event, EMPLOYEE_TABLE
+from common import format_response, INVOICE_TABLE, decimal_to_float, with_int_version, verify_jwt_from_event, cached_employee, with_attachment_url
 from boto3.dynamodb.conditions import Attr
 from operator import itemgetter, attrgetter
 
 def get_employee_by_email(email):
     """
-    Helper function to fetch an employee by their email from the EMPLOYEE_TABLE.
+    Helper function to fetch an employee by their email.
     This is used to "hydrate" the invoice data with full employee details.
-    It also handles converting the DynamoDB set for access_role to a list.
+    ✅ Memory lookup in the cached directory (access_role is already a list);
+    only unknown emails fall back to DynamoDB.
     """
-    if not email:
-        return None
-    response = EMPLOYEE_TABLE.get_item(Key={"email": email.lower()})
-    employee = response.get("Item")
-    if employee:
-        # Check if the access_role is a set and convert it to a list if so
-        if isinstance(employee.get("access_role"), set):
-            employee["access_role"] = list(employee["access_role"])
+    employee = cached_employee(email)
+    if employee and isinstance(employee.get("access_role"), set):
+        employee = {**employee, "access_role": list(employee["access_role"])}
     return employee
 
 def lambda_handler(event, context):
@@ -55,8 +51,7 @@ def lambda_handler(event, context):
     is_admin_or_approver = False
     if not search_term:
         try:
-            employee_response = EMPLOYEE_TABLE.get_item(Key={"email": user_email.lower()})
-            employee = employee_response.get("Item")
+            employee = get_employee_by_email(user_email)
             
             if not employee:
                 return format_response(403, message="Employee record not found for user: " + user_email)
@@ -111,7 +106,9 @@ def lambda_handler(event, context):
         invoices_with_details = []
         for invoice in invoices_raw:
             # Convert Decimal objects to floats for JSON serialization
-            invoice = decimal_to_float(invoice)
+            invoice = with_int_version(decimal_to_float(invoice))
+            # Stored key -> presigned download URL (cached per key)
+            with_attachment_url(invoice)
             
             # Look up the full employee object for the encoder
             encoder_data = invoice.get("encoder")
@@ -0,0 +1,71 @@
+from boto3.dynamodb.conditions import Attr
+from common import (
+    INVOICE_TABLE, DYNAMODB_CLIENT, ITEMS_LAYOUT_COLLECTION,
+    write_line_items, delete_line_items, new_items_generation, line_item_prefix
+)
+
+def migrate_invoice(invoice):
+    """
+    Move one invoice's embedded items into the item collection.
+    The header switch is conditional on the items being unchanged, so an edit
+    that lands mid-migration wins and the invoice is retried on the next run.
+    Rows go into their own generation, so a concurrent run of the same
+    invoice only ever cleans up after itself.
+    """
+    reference_id = invoice["reference_id"]
+    items = invoice.get("items") or []
+    generation = new_items_generation()
+    write_line_items(reference_id, items, generation)
+    try:
+        INVOICE_TABLE.update_item(
+            Key={"reference_id": reference_id},
+            UpdateExpression="SET items_layout = :collection, item_count = :count, items_generation = :generation REMOVE #items",
+            ConditionExpression="attribute_not_exists(items_layout) AND #items = :old",
+            ExpressionAttributeNames={"#items": "items"},
+            ExpressionAttributeValues={
+                ":collection": ITEMS_LAYOUT_COLLECTION,
+                ":count": len(items),
+                ":generation": generation,
+                ":old": items,
+            },
+        )
+        return True
+    except DYNAMODB_CLIENT.exceptions.ConditionalCheckFailedException:
+        delete_line_items(reference_id, prefix=line_item_prefix(generation))
+        return False
+
+def lambda_handler(event, context):
+    """
+    One-off / re-runnable migration from embedded "items" lists to the
+    InvoiceLineItems collection layout. Invoke manually:
+
+        {"dry_run": true}     -> only count candidates
+        {"limit": 500}        -> stop after N invoices (re-run to continue)
+
+    Set INVOICE_ITEMS_LAYOUT=collection on the API functions once it's done;
+    both layouts are readable in the meantime.
+    """
+    event = event or {}
+    dry_run = bool(event.get("dry_run"))
+    limit = int(event.get("limit", 0)) or None
+
+    scan_kwargs = {"FilterExpression": Attr("items_layout").not_exists() & Attr("items").exists()}
+    migrated = skipped = candidates = 0
+    while True:
+        page = INVOICE_TABLE.scan(**scan_kwargs)
+        for invoice in page.get("Items", []):
+            candidates += 1
+            if not dry_run:
+                if migrate_invoice(invoice):
+                    migrated += 1
+                else:
+                    skipped += 1
+            if limit and candidates >= limit:
+                break
+        if (limit and candidates >= limit) or "LastEvaluatedKey" not in page:
+            break
+        scan_kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+    summary = {"candidates": candidates, "migrated": migrated, "skipped_concurrent_edit": skipped, "dry_run": dry_run}
+    print(f"migrate_invoice_items: {summary}")
+    return summary
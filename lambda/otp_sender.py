@@ -0,0 +1,72 @@
+import json, time, random
+from common import send_otp_email, OTP_SEND_MAX_RETRIES, OTP_TABLE, DYNAMODB_CLIENT
+
+def send_with_retries(email, otp_code):
+    """Send one OTP email, backing off with jitter on SES errors/throttling."""
+    for attempt in range(OTP_SEND_MAX_RETRIES + 1):
+        try:
+            send_otp_email(email, otp_code, raise_errors=True)
+            return
+        except Exception:
+            if attempt >= OTP_SEND_MAX_RETRIES:
+                raise
+            time.sleep(min(2 ** attempt * 0.1, 2.0) * (0.5 + random.random()))
+
+def send_queued(message):
+    """
+    Messages are {"email", "nonce"}; the code itself is read from the OTP
+    item. A missing item or a different nonce means the OTP was used,
+    expired or superseded by a newer request, so there is nothing to send.
+    """
+    email, nonce = message["email"], message["nonce"]
+    item = OTP_TABLE.get_item(Key={"email": email}, ConsistentRead=True).get("Item") or {}
+    if item.get("outbox_nonce") != nonce or "outbox_code" not in item:
+        print(f"OTP for {email} no longer pending, skipping")
+        return
+    if int(item.get("expires_at", 0)) <= int(time.time()):
+        print(f"OTP for {email} expired before it could be sent, skipping")
+        return
+
+    send_with_retries(email, item["outbox_code"])
+
+    # Sent: the plaintext code has no reason to stay at rest
+    try:
+        OTP_TABLE.update_item(
+            Key={"email": email},
+            UpdateExpression="REMOVE outbox_code, outbox_nonce",
+            ConditionExpression="outbox_nonce = :n",
+            ExpressionAttributeValues={":n": nonce},
+        )
+    except DYNAMODB_CLIENT.exceptions.ConditionalCheckFailedException:
+        pass  # Replaced or consumed in the meantime
+
+def lambda_handler(event, context):
+    """
+    Sends queued OTP emails off the request path.
+
+    Accepts either:
+      - an SQS batch ({"Records": [...]}) -> returns batchItemFailures so
+        only the failed messages are redelivered
+      - an async invoke payload ({"messages": [{"email", "nonce"}]}) ->
+        raises on failure so Lambda's async retry picks it up
+    """
+    if "Records" in event:
+        failures = []
+        for record in event["Records"]:
+            try:
+                send_queued(json.loads(record["body"]))
+            except Exception as e:
+                print(f"OTP send failed for message {record.get('messageId')}: {e}")
+                failures.append({"itemIdentifier": record["messageId"]})
+        return {"batchItemFailures": failures}
+
+    failed = 0
+    for message in event.get("messages", []):
+        try:
+            send_queued(message)
+        except Exception as e:
+            print(f"OTP send failed for {message.get('email')}: {e}")
+            failed += 1
+    if failed:
+        raise RuntimeError(f"{failed} OTP email(s) could not be sent")
+    return {"sent": len(event.get("messages", []))}
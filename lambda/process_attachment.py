@@ -0,0 +1,141 @@
+import io
+import os
+from urllib.parse import unquote_plus
+from concurrent.futures import ThreadPoolExecutor
+
+from common import (
+    S3, BUCKET_NAME, ATTACHMENT_PREFIX, derivative_key, record_attachment_previews
+)
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow missing -> no image derivatives
+    Image = None
+
+try:
+    import pypdfium2  # Optional: PDF first-page thumbnails
+except ImportError:
+    pypdfium2 = None
+
+try:
+    import pikepdf  # Optional: PDF stream recompression
+except ImportError:
+    pikepdf = None
+
+THUMBNAIL_SIZE = (int(os.getenv("THUMBNAIL_MAX_PX", "320")),) * 2
+COMPRESSED_MAX_PX = int(os.getenv("COMPRESSED_MAX_PX", "2000"))
+COMPRESSED_QUALITY = int(os.getenv("COMPRESSED_QUALITY", "80"))
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+def _encode(image, max_px, quality):
+    """Downscale and encode as WebP, falling back to JPEG if WebP is unavailable."""
+    image = image.copy()
+    image.thumbnail((max_px, max_px) if isinstance(max_px, int) else max_px)
+    out = io.BytesIO()
+    try:
+        image.save(out, format="WEBP", quality=quality, method=4)
+        return out.getvalue(), "webp", "image/webp"
+    except (KeyError, OSError):
+        out = io.BytesIO()
+        image.convert("RGB").save(out, format="JPEG", quality=quality, optimize=True, progressive=True)
+        return out.getvalue(), "jpg", "image/jpeg"
+
+def build_derivatives(data, content_type):
+    """
+    Returns {name: (bytes, suffix, content_type)} for the derivatives we can
+    produce for this attachment. Unsupported types return {}.
+    """
+    derivatives = {}
+    is_pdf = content_type == "application/pdf" or data[:5] == b"%PDF-"
+
+    if is_pdf:
+        if pypdfium2 is not None and Image is not None:
+            pdf = pypdfium2.PdfDocument(data)
+            try:
+                first_page = pdf[0].render(scale=1).to_pil()
+            finally:
+                pdf.close()
+            body, ext, ctype = _encode(first_page, THUMBNAIL_SIZE, 75)
+            derivatives["thumbnail"] = (body, f"thumb.{ext}", ctype)
+        if pikepdf is not None:
+            out = io.BytesIO()
+            with pikepdf.open(io.BytesIO(data)) as pdf:
+                pdf.save(out, compress_streams=True, object_stream_mode=pikepdf.ObjectStreamMode.generate)
+            if out.tell() < len(data):
+                derivatives["compressed"] = (out.getvalue(), "compressed.pdf", "application/pdf")
+        return derivatives
+
+    if Image is None:
+        return derivatives
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception:
+        return derivatives  # Not an image we can decode
+
+    if image.mode not in ("RGB", "RGBA", "L"):
+        image = image.convert("RGB")
+
+    body, ext, ctype = _encode(image, THUMBNAIL_SIZE, 75)
+    derivatives["thumbnail"] = (body, f"thumb.{ext}", ctype)
+
+    body, ext, ctype = _encode(image, COMPRESSED_MAX_PX, COMPRESSED_QUALITY)
+    if len(body) < len(data):
+        derivatives["compressed"] = (body, f"compressed.{ext}", ctype)
+    return derivatives
+
+def process_object(bucket, key):
+    """Generate, upload and record the derivatives of one attachment."""
+    obj = S3.get_object(Bucket=bucket, Key=key)
+    data = obj["Body"].read()
+    derivatives = build_derivatives(data, obj.get("ContentType"))
+    if not derivatives:
+        return {"key": key, "previews": {}}
+
+    previews = {}
+    for name, (body, suffix, ctype) in derivatives.items():
+        out_key = derivative_key(key, suffix)
+        S3.put_object(Bucket=bucket, Key=out_key, Body=body, ContentType=ctype)
+        previews[name] = out_key
+
+    invoices = record_attachment_previews(key, previews)
+    return {"key": key, "previews": previews, "invoices_updated": invoices}
+
+def _objects_from_event(event):
+    """(bucket, key) pairs from an S3 notification or an EventBridge 'Object Created' event."""
+    if "Records" in event:
+        for record in event["Records"]:
+            s3 = record.get("s3") or {}
+            yield s3.get("bucket", {}).get("name", BUCKET_NAME), unquote_plus(s3.get("object", {}).get("key", ""))
+    elif "detail" in event:
+        detail = event["detail"]
+        yield detail.get("bucket", {}).get("name", BUCKET_NAME), detail.get("object", {}).get("key", "")
+
+def lambda_handler(event, context):
+    """
+    S3-triggered post-processing for invoice attachments: writes a small
+    thumbnail and (when smaller) a recompressed copy under previews/ and
+    records their keys on the attachment index and referencing invoices.
+
+    Batches are spread over a thread pool; Pillow releases the GIL while
+    decoding, resizing and encoding, and Lambda has no /dev/shm for
+    multiprocessing pools.
+    """
+    objects = [(b, k) for b, k in _objects_from_event(event) if k.startswith(ATTACHMENT_PREFIX)]
+    if not objects:
+        return {"processed": 0, "results": []}
+
+    results, failures = [], []
+    with ThreadPoolExecutor(max_workers=max(1, min(PIPELINE_WORKERS, len(objects)))) as pool:
+        futures = {pool.submit(process_object, b, k): k for b, k in objects}
+        for future, key in futures.items():
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"Attachment post-processing failed for {key}: {e}")
+                failures.append(key)
+
+    if failures:
+        # Let the async invoke retry; derivatives are idempotent overwrites
+        raise RuntimeError(f"Post-processing failed for {len(failures)} object(s): {failures}")
+    return {"processed": len(results), "results": results}
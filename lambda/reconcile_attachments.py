@@ -0,0 +1,146 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import (
+    S3, BUCKET_NAME, INVOICE_TABLE, ATTACHMENT_PREFIX,
+    CONTENT_ADDRESSED_PREFIX, PREVIEWS_PREFIX, attachment_key_of, digest_of_key,
+    begin_attachment_deletion, finish_attachment_deletion, forget_attachment_previews
+)
+
+# Uploads land in S3 before their invoice is written (presigned flow), so
+# only objects older than this are eligible for deletion.
+ORPHAN_GRACE_SECONDS = int(os.getenv("ORPHAN_GRACE_SECONDS", "86400"))
+RECONCILE_DRY_RUN = os.getenv("RECONCILE_DRY_RUN", "false").lower() == "true"
+RECONCILE_WORKERS = int(os.getenv("RECONCILE_WORKERS", "16"))
+INVOICE_SCAN_SEGMENTS = int(os.getenv("INVOICE_SCAN_SEGMENTS", "4"))
+DELETE_BATCH_SIZE = 1000  # DeleteObjects limit
+
+_HEX = "0123456789abcdef"
+
+def _list_shard(prefix):
+    """All (key, last_modified_epoch) under prefix."""
+    objects = []
+    for page in S3.get_paginator("list_objects_v2").paginate(Bucket=BUCKET_NAME, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            objects.append((obj["Key"], obj["LastModified"].timestamp()))
+    return objects
+
+def list_objects_parallel(shards):
+    """List several prefixes concurrently (ListObjectsV2 pages are sequential per prefix)."""
+    with ThreadPoolExecutor(max_workers=min(RECONCILE_WORKERS, len(shards))) as pool:
+        return dict(obj for shard in pool.map(_list_shard, shards) for obj in shard)
+
+def _scan_segment(segment):
+    keys = set()
+    scan_kwargs = {
+        "ProjectionExpression": "file_key, file_url, previews",
+        "Segment": segment,
+        "TotalSegments": INVOICE_SCAN_SEGMENTS,
+    }
+    while True:
+        page = INVOICE_TABLE.scan(**scan_kwargs)
+        for invoice in page.get("Items", []):
+            key = attachment_key_of(invoice)
+            if key:
+                keys.add(key)
+            keys.update((invoice.get("previews") or {}).values())
+        if "LastEvaluatedKey" not in page:
+            return keys
+        scan_kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+def referenced_keys():
+    """Every attachment/preview key referenced by an invoice (parallel scan)."""
+    with ThreadPoolExecutor(max_workers=INVOICE_SCAN_SEGMENTS) as pool:
+        return set().union(*pool.map(_scan_segment, range(INVOICE_SCAN_SEGMENTS)))
+
+def delete_keys(keys):
+    """DeleteObjects in batches of 1000; returns the number of keys S3 reported as errors."""
+    keys = sorted(keys)
+    batches = [keys[i:i + DELETE_BATCH_SIZE] for i in range(0, len(keys), DELETE_BATCH_SIZE)]
+
+    def delete_batch(batch):
+        resp = S3.delete_objects(
+            Bucket=BUCKET_NAME,
+            Delete={"Objects": [{"Key": k} for k in batch], "Quiet": True},
+        )
+        for err in resp.get("Errors", []):
+            print(f"DeleteObjects error for {err.get('Key')}: {err.get('Code')} {err.get('Message')}")
+        return len(resp.get("Errors", []))
+
+    if not batches:
+        return 0
+    with ThreadPoolExecutor(max_workers=min(RECONCILE_WORKERS, len(batches))) as pool:
+        return sum(pool.map(delete_batch, batches))
+
+def claim_for_deletion(key):
+    """
+    Tombstone the Attachments index entry of a content-addressed orphan
+    unless it still has references (e.g. an invoice being created right now
+    claimed it). While tombstoned, no invoice can claim or re-record it.
+    Returns False when the object must be kept.
+    """
+    digest = digest_of_key(key)
+    return begin_attachment_deletion(digest) if digest else True
+
+def lambda_handler(event, context):
+    """
+    Scheduled orphan sweep: deletes attachments no invoice references, plus
+    previews whose source attachment is gone or orphaned, and drops the
+    Attachments index entries of deleted content-addressed objects.
+    Set RECONCILE_DRY_RUN=true to only report counts.
+
+    Listing is sharded by the first hex character of the key (uuid and
+    sha256 keys are both hex) so pages are fetched in parallel.
+    """
+    started = time.time()
+    cutoff = started - ORPHAN_GRACE_SECONDS
+
+    shards = [ATTACHMENT_PREFIX + c for c in _HEX] + [CONTENT_ADDRESSED_PREFIX + c for c in _HEX]
+    attachments = list_objects_parallel(shards)
+    previews = list_objects_parallel([PREVIEWS_PREFIX])
+    referenced = referenced_keys()
+
+    orphans = {k for k, modified in attachments.items() if modified < cutoff} - referenced
+
+    def previews_without_source(deleted):
+        live_sources = set(attachments) - deleted
+        return {
+            k for k, modified in previews.items()
+            if modified < cutoff
+            and ATTACHMENT_PREFIX + k[len(PREVIEWS_PREFIX):].rsplit(".", 2)[0] not in live_sources
+        } - referenced
+
+    orphan_previews = previews_without_source(orphans)
+
+    summary = {
+        "attachments_listed": len(attachments),
+        "previews_listed": len(previews),
+        "referenced": len(referenced),
+        "orphans": len(orphans),
+        "orphan_previews": len(orphan_previews),
+        "dry_run": RECONCILE_DRY_RUN,
+    }
+    if RECONCILE_DRY_RUN:
+        print(f"Reconcile dry run: {summary}")
+        return summary
+
+    # Same protocol as release_attachment: tombstone, delete the object, drop
+    # the tombstone, so a concurrent claim either wins or fails cleanly
+    orphan_list = sorted(orphans)
+    with ThreadPoolExecutor(max_workers=RECONCILE_WORKERS) as pool:
+        releasable = {k for k, ok in zip(orphan_list, pool.map(claim_for_deletion, orphan_list)) if ok}
+    summary["kept_referenced"] = len(orphans) - len(releasable)
+    summary["delete_errors"] = delete_keys(releasable | previews_without_source(releasable))
+    digests = [d for d in map(digest_of_key, sorted(releasable)) if d]
+    if digests:
+        with ThreadPoolExecutor(max_workers=RECONCILE_WORKERS) as pool:
+            list(pool.map(finish_attachment_deletion, digests))
+    uuid_keys = [k for k in sorted(releasable) if not digest_of_key(k)]
+    if uuid_keys:
+        with ThreadPoolExecutor(max_workers=RECONCILE_WORKERS) as pool:
+            list(pool.map(forget_attachment_previews, uuid_keys))
+
+    summary["elapsed_seconds"] = round(time.time() - started, 2)
+    print(f"Reconcile finished: {summary}")
+    return summary
@@ -29,7 +29,10 @@ def lambda_handler(event, context):
 
         ok, payload = verify_refresh_token(email, refresh_token)
         if not ok:
-            return format_response(401, message="Invalid or expired refresh token")
+            reason = (payload or {}).get("reason")
+            if reason == "conflict":
+                return format_response(409, message="Refresh already in progress, please retry", errors={"refresh_token": reason})
+            return format_response(401, message="Invalid or expired refresh token", errors={"refresh_token": reason})
 
         # ✅ payload contains new access + refresh (rotated)
         try:
@@ -4,32 +4,15 @@ from common import (
     OTP_TABLE,
     is_valid_workmail_user,
     hash_otp,
-    SES,
-    EMAIL_SOURCE,
-    SES_MOCK_MODE,
+    dispatch_otp_email,
+    OTP_DISPATCH_MODE,
+    OTP_QUEUED_MODES,
     OTP_MAX_ATTEMPTS,
     OTP_WINDOW_SECONDS
 )
 
 OTP_TTL_SECONDS = 300  # 5 minutes
 
-def send_otp_email(email, otp_code):
-    subject = "Your OTP Code"
-    body_text = f"Your OTP code is: {otp_code}\nIt is valid for 5 minutes."
-    try:
-        SES.send_email(
-            Source=EMAIL_SOURCE,
-            Destination={"ToAddresses": [email]},
-            Message={
-                "Subject": {"Data": subject},
-                "Body": {"Text": {"Data": body_text}}
-            },
-        )
-    except Exception as e:
-        print(f"Error sending email: {e}")
-        if not SES_MOCK_MODE:
-            raise
-
 def generate_otp():
     return f"{random.randint(100000, 999999)}"
 
@@ -74,12 +57,20 @@ def lambda_handler(event, context):
             "first_attempt_at": first_attempt_at
         }
 
+        # Queued sends carry only a reference; the sender reads the code from
+        # this item and removes it once the email is out
+        nonce = None
+        if OTP_DISPATCH_MODE in OTP_QUEUED_MODES:
+            nonce = secrets.token_hex(8)
+            item["outbox_code"] = otp_code
+            item["outbox_nonce"] = nonce
+
         # For local testing only
         if os.environ.get("WORKMAIL_ORGANIZATION_ID") == "local-dev":
             item["otp_code"] = otp_code
 
         try:
-            print("Putting item to DynamoDB:", item)
+            print("Putting item to DynamoDB:", {k: v for k, v in item.items() if k != "outbox_code"})
             OTP_TABLE.put_item(Item=item)
         except Exception as e:
             print("DynamoDB put_item failed:", e)
@@ -87,8 +78,8 @@ def lambda_handler(event, context):
 
         # OTP_TABLE.put_item(Item=item)
 
-        # ✅ Send OTP
-        send_otp_email(email, otp_code)
+        # ✅ Send OTP (queued unless OTP_DISPATCH_MODE=sync)
+        dispatch_otp_email(email, otp_code, nonce)
 
         return format_response(200, message="OTP sent successfully", data={"email": email})
 
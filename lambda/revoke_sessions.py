@@ -0,0 +1,72 @@
+import json
+from common import (
+    format_response, verify_jwt_from_event, revoke_all_sessions, revoke_session_family,
+    decode_stateless_refresh_token
+)
+
+def _refresh_token_of(event, body):
+    """Refresh token from the body or the refresh_token cookie (as in refresh_token.py)."""
+    if body.get("refresh_token"):
+        return body["refresh_token"]
+    headers = event.get("headers", {}) or {}
+    cookie_header = headers.get("Cookie") or headers.get("cookie") or ""
+    for part in cookie_header.split(";"):
+        part = part.strip()
+        if part.startswith("refresh_token="):
+            return part.split("=", 1)[1].strip()
+    return None
+
+def lambda_handler(event, context):
+    """
+    Signs the caller out everywhere by bumping their revocation epoch.
+    Every refresh token issued before this call stops working.
+
+    With {"scope": "current"} only the session family of the presented
+    (stateless) refresh token is revoked: the other devices stay signed in.
+    """
+    payload, error = verify_jwt_from_event(event)
+    if error:
+        return format_response(401, message="Unauthorized", errors={"auth": error})
+
+    try:
+        email = (payload.get("email") or "").strip().lower()
+        if not email:
+            return format_response(401, message="Missing email in token payload")
+
+        try:
+            body = json.loads(event.get("body") or "{}")
+        except json.JSONDecodeError:
+            return format_response(400, message="Invalid JSON body")
+        if not isinstance(body, dict):
+            body = {}
+
+        headers = {
+            "Content-Type": "application/json",
+            "Set-Cookie": "refresh_token=; HttpOnly; Path=/; Max-Age=0; SameSite=Lax"
+        }
+
+        if body.get("scope") == "current":
+            claims, reason = decode_stateless_refresh_token(email, _refresh_token_of(event, body) or "")
+            if claims is None or not claims.get("fid"):
+                return format_response(
+                    400,
+                    message="Validation Error",
+                    errors={"refresh_token": reason or "Token has no session family"}
+                )
+            revoke_session_family(email, claims["fid"])
+            return format_response(
+                200,
+                message="Session revoked",
+                data={"email": email, "family_id": claims["fid"]}
+            ) | {"headers": headers}
+
+        epoch = revoke_all_sessions(email)
+
+        return format_response(
+            200,
+            message="All sessions revoked",
+            data={"email": email, "revocation_epoch": epoch}
+        ) | {"headers": headers}
+
+    except Exception as e:
+        return format_response(500, message="Internal Server Error", errors={"exception": str(e)})
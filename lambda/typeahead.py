@@ -0,0 +1,63 @@
+import time
+from common import (
+    format_response, cached_employee_directory, api_handler, validation_error,
+    timing, map_errors, authenticate, cache_control, response_cache,
+    employee_search_index, account_search_index, project_class_search_index
+)
+
+TYPEAHEAD_SOURCES = ("employees", "accounts", "project_classes")
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+MIN_QUERY_LENGTH = 1
+
+def _employee_rows(emails):
+    directory = cached_employee_directory()
+    return [
+        {k: directory[e].get(k) for k in ("email", "first_name", "last_name", "access_role")}
+        for e in emails if e in directory
+    ]
+
+def typeahead(request):
+    """
+    Prefix suggestions for dropdowns, so the frontend no longer downloads
+    whole lists to filter them.
+
+    Query parameters:
+      q      text typed so far (prefix of any word of a name)
+      types  comma-separated subset of employees,accounts,project_classes (default: all)
+      limit  matches per type (default 10, max 50)
+
+    Lookups run against in-memory sorted indexes built once per cache
+    reload, so a keystroke costs a couple of binary searches.
+    """
+    q = request.query_str("q", "")
+    if len(q) < MIN_QUERY_LENGTH:
+        raise validation_error("q", "Type at least one character")
+
+    types = request.query_list("types", TYPEAHEAD_SOURCES)
+    unknown = [t for t in types if t not in TYPEAHEAD_SOURCES]
+    if unknown:
+        raise validation_error("types", f"Unknown types {unknown}; use {list(TYPEAHEAD_SOURCES)}")
+
+    limit = min(max(request.query_int("limit", DEFAULT_LIMIT), 1), MAX_LIMIT)
+
+    started = time.perf_counter()
+    data = {}
+    if "employees" in types:
+        data["employees"] = _employee_rows(employee_search_index().search(q, limit))
+    if "accounts" in types:
+        data["accounts"] = account_search_index().search(q, limit)
+    if "project_classes" in types:
+        data["project_classes"] = project_class_search_index().search(q, limit)
+    data["took_us"] = round((time.perf_counter() - started) * 1e6)
+
+    return format_response(200, message="Suggestions fetched successfully", data=data)
+
+lambda_handler = api_handler(
+    timing, map_errors, authenticate,
+    # Same prefix, same answer for a minute: let the browser reuse it while typing/backspacing
+    cache_control("private, max-age=60"),
+    # Suggestions don't depend on the caller, so warm containers share them across
+    # users; project classes come from Accounts, so two generations cover all sources
+    response_cache(30, domains=("employees", "accounts")),
+)(typeahead)
@@ -1,10 +1,296 @@
 import json
-from common import format_response, INVOICE_TABLE, verify_jwt_from_event
+import bisect
+from decimal import Decimal
+from common import (
+    format_response, INVOICE_TABLE, verify_jwt_from_event, decimal_to_float,
+    uses_item_collection, delete_line_items, write_line_items, new_items_generation, line_item_prefix,
+    DYNAMODB_CLIENT, condition_failure_item, with_attachment_url, ITEMS_LAYOUT_COLLECTION,
+    VERSION_NAMES, invoice_version, etag_of, with_int_version, parse_if_match, version_condition,
+    validate_invoice_update, validate_line_item, validate_field, assign_item_ids
+)
+
+# =========================================================
+# JSON-PATCH (RFC 6902 subset) -> targeted UpdateExpression
+# =========================================================
+PATCHABLE_FIELDS = ("company_name", "tin", "transaction_date", "status")
+PATCHABLE_ITEM_FIELDS = ("particulars", "project_class", "account", "vatable", "amount")
+MAX_PATCH_OPS = 100
+
+# The 'status' field has been added to the allowed_fields list.
+# Values are checked by INVOICE_UPDATE_SCHEMA in common.
+ALLOWED_FIELDS = ("company_name", "tin", "transaction_date", "items", "status")
+
+class PatchError(ValueError):
+    """Invalid or unsupported patch operation (-> 400)."""
+
+def _parse_pointer(path):
+    if not isinstance(path, str) or not path.startswith("/"):
+        raise PatchError(f"Invalid JSON pointer: {path!r}")
+    return [t.replace("~1", "/").replace("~0", "~") for t in path[1:].split("/")]
+
+def _checked(n, validated):
+    """Unwrap a schema result for op n, raising PatchError on the first problem."""
+    value, errors = validated
+    if errors:
+        path, message = next(iter(errors.items()))
+        raise PatchError(f"Operation {n}: {'value' if path == 'body' else path} {message}")
+    return value
+
+def _overlaps(a, b):
+    shorter = min(len(a), len(b))
+    return a[:shorter] == b[:shorter]
+
+def build_patch_update(ops, expected_version=None):
+    """
+    Translate patch operations into update_item kwargs:
+      - add/replace  /field, /items/3, /items/3/amount -> SET
+      - add          /items/-                          -> SET list_append
+      - remove       /items/3, /items/3/<optional>     -> REMOVE
+      - test         any of the above                  -> ConditionExpression
+    Item indices are read in op order, as RFC 6902 applies them: after
+    remove /items/3, /items/4 means the stored item 5.
+    replace/remove also require the target to exist, so a stale index can't
+    silently append or hit the wrong item; add on /items/3/<field> only
+    requires item 3 to exist, since the field itself may be new. Every patch bumps the invoice
+    version. Returns (kwargs, touches_items, touches_status).
+    """
+    if not isinstance(ops, list) or not ops:
+        raise PatchError("Patch must be a non-empty array of operations")
+    if len(ops) > MAX_PATCH_OPS:
+        raise PatchError(f"At most {MAX_PATCH_OPS} operations per patch")
+
+    names, values = {"#items": "items"}, {}
+    sets, removes, conditions, touched = [], [], ["attribute_exists(reference_id)"], []
+    removed_items = []  # Stored-list indices of items removed so far, sorted
+
+    def name(field):
+        placeholder = f"#{field}"
+        names[placeholder] = field
+        return placeholder
+
+    def value(v):
+        placeholder = f":v{len(values)}"
+        values[placeholder] = v
+        return placeholder
+
+    for n, op in enumerate(ops):
+        if not isinstance(op, dict):
+            raise PatchError(f"Operation {n} must be an object")
+        kind = op.get("op")
+        if kind not in ("add", "replace", "remove", "test"):
+            raise PatchError(f"Operation {n}: unsupported op {kind!r}")
+        if kind != "remove" and "value" not in op:
+            raise PatchError(f"Operation {n}: '{kind}' needs a value")
+        tokens = _parse_pointer(op.get("path"))
+
+        if tokens[0] == "items":
+            if len(tokens) == 2 and tokens[1] == "-" and kind == "add":
+                item = assign_item_ids([_checked(n, validate_line_item(op["value"]))])[0]
+                sets.append(f"#items = list_append(if_not_exists(#items, {value([])}), {value([item])})")
+                touched.append(("items",))
+                continue
+            if len(tokens) not in (2, 3) or not tokens[1].isdigit():
+                raise PatchError(f"Operation {n}: items paths are /items/<index>[/<field>] or /items/-")
+            # Ops apply in order (RFC 6902), but one UpdateExpression acts on the
+            # stored list: map the index past the items earlier ops removed
+            index = int(tokens[1])
+            for gone in removed_items:
+                if gone > index:
+                    break
+                index += 1
+            target = f"#items[{index}]"
+            key = ("items", index)
+            if len(tokens) == 3:
+                if tokens[2] not in PATCHABLE_ITEM_FIELDS + ("remarks",):
+                    raise PatchError(f"Operation {n}: item field {tokens[2]!r} cannot be patched")
+                if kind == "remove" and tokens[2] in PATCHABLE_ITEM_FIELDS:
+                    raise PatchError(f"Operation {n}: {tokens[2]!r} is required and cannot be removed")
+                target += f".{name(tokens[2])}"
+                key += (tokens[2],)
+            elif kind == "add":
+                raise PatchError(f"Operation {n}: items can only be inserted at the end (/items/-)")
+        else:
+            if len(tokens) != 1 or tokens[0] not in PATCHABLE_FIELDS:
+                raise PatchError(f"Operation {n}: {op.get('path')!r} cannot be patched")
+            if kind == "remove":
+                raise PatchError(f"Operation {n}: {tokens[0]!r} is required and cannot be removed")
+            target = name(tokens[0])
+            key = (tokens[0],)
+
+        if kind == "test":
+            conditions.append(f"{target} = {value(op['value'])}")
+            continue
+
+        if any(_overlaps(key, other) for other in touched):
+            raise PatchError(f"Operation {n}: {op['path']} overlaps another operation")
+        touched.append(key)
+
+        if kind != "remove":
+            # Same schema as a full update: types, ranges and money places
+            if key[0] != "items":
+                op_value = _checked(n, validate_field(validate_invoice_update, key[0], op["value"]))
+            elif len(key) == 3:
+                op_value = _checked(n, validate_field(validate_line_item, key[2], op["value"]))
+            else:
+                op_value = _checked(n, validate_line_item(op["value"]))
+
+        if kind == "remove":
+            if key[0] == "items" and len(key) == 2:
+                bisect.insort(removed_items, key[1])
+            removes.append(target)
+            conditions.append(f"attribute_exists({target})")
+        else:
+            if kind == "replace":
+                conditions.append(f"attribute_exists({target})")
+            elif key[0] == "items":
+                # add on an item field may create it, but the item itself must exist
+                conditions.append(f"attribute_exists(#items[{key[1]}])")
+            sets.append(f"{target} = {value(op_value)}")
+
+    touches_items = any(key[0] == "items" for key in touched) or "#items[" in " ".join(conditions)
+    touches_status = ("status",) in touched
+    if touches_items:
+        conditions.append("attribute_not_exists(items_layout)")  # Embedded layout only
+    if touches_status:
+        conditions.append(f"#status = {value('Pending')}")
+        names["#status"] = "status"
+    if not sets and not removes:
+        raise PatchError("Patch has no add/replace/remove operations")
+    version_expr, version_values = version_condition(expected_version)
+    if version_expr:
+        conditions.append(version_expr)
+        values.update(version_values)
+
+    expression = []
+    if sets:
+        expression.append("SET " + ", ".join(sets))
+    if removes:
+        expression.append("REMOVE " + ", ".join(removes))
+    expression.append(f"ADD #version {value(1)}")
+    names.update(VERSION_NAMES)
+    if not any("#items" in part for part in expression + conditions):
+        del names["#items"]
+
+    kwargs = {
+        "UpdateExpression": " ".join(expression),
+        "ConditionExpression": " AND ".join(conditions),
+        "ExpressionAttributeNames": names,
+        "ExpressionAttributeValues": values,
+    }
+    return kwargs, touches_items, touches_status
+
+def _precondition_failed(old):
+    """412 carrying the current version so the client can re-read and retry."""
+    response = format_response(
+        412,
+        message="Invoice was modified by someone else",
+        errors={"version": f"Current version is {invoice_version(old)}"},
+        data={"reference_id": old.get("reference_id"), "version": invoice_version(old)}
+    )
+    response["headers"]["ETag"] = etag_of(old)
+    return response
+
+def _updated(message, invoice, data=None):
+    response = format_response(200, message=message, data=data if data is not None else invoice)
+    response["headers"]["ETag"] = etag_of(invoice)
+    return response
+
+def apply_patch(reference_id, ops, expected_version=None):
+    """Apply a JSON-Patch in one conditional write; returns an API response."""
+    try:
+        kwargs, touches_items, touches_status = build_patch_update(ops, expected_version)
+    except PatchError as e:
+        return format_response(400, message="Invalid patch", errors={"patch": str(e)})
+
+    try:
+        resp = INVOICE_TABLE.update_item(
+            Key={"reference_id": reference_id},
+            ReturnValues="UPDATED_NEW",
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
+            **kwargs
+        )
+    except DYNAMODB_CLIENT.exceptions.ConditionalCheckFailedException as e:
+        old = condition_failure_item(e)
+        if old is None:
+            return format_response(404, message="Invoice not found")
+        if expected_version is not None and invoice_version(old) != expected_version:
+            return _precondition_failed(old)
+        if touches_items and uses_item_collection(old):
+            return format_response(409, message="Item patches are not supported for this invoice; use the item endpoints")
+        if touches_status and old.get("status") != "Pending":
+            return format_response(409, message="Cannot update status of a non-pending invoice")
+        return format_response(409, message="Patch precondition failed", errors={"patch": "A test op did not match or a target no longer exists"})
+
+    updated = with_int_version(decimal_to_float(resp.get("Attributes", {})))
+    return _updated(
+        "Invoice patched successfully",
+        updated,
+        data={"reference_id": reference_id, "applied_ops": len(ops), "updated": updated}
+    )
+
+def conditional_update(reference_id, body, expected_version=None, collection_version=None, items_generation=None):
+    """
+    Full-field update in a single round trip: the "status is Pending" check,
+    the If-Match version and the items layout are all part of the condition,
+    and ALL_NEW returns the stored invoice.
+
+    collection_version pins the write for collection-layout invoices, where
+    only item_count lives on the header; it also switches the header to
+    items_generation, the already-written generation of replacement rows.
+    """
+    names, values, sets = dict(VERSION_NAMES), {":one": 1}, []
+    conditions = ["attribute_exists(reference_id)"]
+
+    for field in ALLOWED_FIELDS:
+        if field not in body:
+            continue
+        if field == "items" and collection_version is not None:
+            sets.append("#item_count = :item_count, #items_generation = :items_generation")
+            values[":item_count"] = len(body["items"])
+            values[":items_generation"] = items_generation
+            names["#item_count"] = "item_count"
+            names["#items_generation"] = "items_generation"
+            continue
+        sets.append(f"#{field} = :{field}")
+        values[f":{field}"] = body[field]
+        names[f"#{field}"] = field
+
+    if "status" in body:
+        conditions.append("#status = :pending")  # Checked against the stored value
+        values[":pending"] = "Pending"
+    if "items" in body:
+        if collection_version is None:
+            conditions.append("attribute_not_exists(items_layout)")
+        else:
+            conditions.append("items_layout = :collection")
+            values[":collection"] = ITEMS_LAYOUT_COLLECTION
+    version_expr, version_values = version_condition(
+        collection_version if collection_version is not None else expected_version
+    )
+    if version_expr:
+        conditions.append(version_expr)
+        values.update(version_values)
+
+    resp = INVOICE_TABLE.update_item(
+        Key={"reference_id": reference_id},
+        UpdateExpression="SET " + ", ".join(sets) + " ADD #version :one",
+        ConditionExpression=" AND ".join(conditions),
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values,
+        ReturnValues="ALL_NEW",
+        ReturnValuesOnConditionCheckFailure="ALL_OLD",
+    )
+    return resp["Attributes"]
 
 def lambda_handler(event, context):
     """
     Updates invoice fields for the given reference_id.
-    Only fields in allowed_fields can be updated.
+    Only fields in ALLOWED_FIELDS can be updated.
+
+    A JSON-Patch body (an array of ops, or {"patch": [...]}) is applied as a
+    single targeted, conditional write instead of a full replacement.
+    Both forms honour If-Match (the invoice version, returned as ETag) and
+    answer 412 when the invoice changed since the client read it.
     """
     payload, error = verify_jwt_from_event(event)
     if error:
@@ -16,51 +302,61 @@ def lambda_handler(event, context):
             return format_response(400, message="Missing reference_id in path parameters")
 
         try:
-            body = json.loads(event.get("body") or "{}")
+            body = json.loads(event.get("body") or "{}", parse_float=Decimal)
         except json.JSONDecodeError:
             return format_response(400, message="Invalid JSON body")
 
-        # The 'status' field has been added to the allowed_fields list.
-        allowed_fields = ["company_name", "tin", "transaction_date", "items", "status"]
-
-        existing = INVOICE_TABLE.get_item(Key={"reference_id": reference_id})
-        if "Item" not in existing:
-            return format_response(404, message="Invoice not found")
-
-        # Before updating, check if the status is allowed to be changed from "Pending"
-        if "status" in body and existing["Item"]["status"] != "Pending":
-            return format_response(409, message="Cannot update status of a non-pending invoice")
-
-        update_expr = []
-        expr_attr_values = {}
+        try:
+            expected_version = parse_if_match(event)
+        except ValueError as e:
+            return format_response(400, message="Invalid If-Match header", errors={"If-Match": str(e)})
 
-        for field in allowed_fields:
-            if field in body:
-                update_expr.append(f"#{field} = :{field}")
-                expr_attr_values[f":{field}"] = body[field]
+        if isinstance(body, list):
+            return apply_patch(reference_id, body, expected_version)
+        if isinstance(body, dict) and "patch" in body:
+            return apply_patch(reference_id, body["patch"], expected_version)
 
-        if not update_expr:
+        # Unknown fields are dropped; every problem with the rest is reported at once
+        body, errors = validate_invoice_update(body)
+        if errors:
+            return format_response(400, message="Validation Error", errors=errors)
+        if not body:
             return format_response(400, message="No valid fields to update")
+        if "items" in body:
+            body["items"] = assign_item_ids(body["items"])
 
-        # Add a placeholder for a new field name and value for the status attribute
-        # to avoid conflicts with DynamoDB reserved keywords.
-        expression_attribute_names = {}
-        for field in body.keys():
-            if field in allowed_fields:
-                expression_attribute_names[f"#{field}"] = field
-                
-        INVOICE_TABLE.update_item(
-            Key={"reference_id": reference_id},
-            UpdateExpression="SET " + ", ".join(update_expr),
-            ExpressionAttributeValues=expr_attr_values,
-            ExpressionAttributeNames=expression_attribute_names
-        )
+        try:
+            invoice = conditional_update(reference_id, body, expected_version)
+        except DYNAMODB_CLIENT.exceptions.ConditionalCheckFailedException as e:
+            old = condition_failure_item(e)
+            if old is None:
+                return format_response(404, message="Invoice not found")
+            if expected_version is not None and invoice_version(old) != expected_version:
+                return _precondition_failed(old)
+            if "status" in body and old.get("status") != "Pending":
+                return format_response(409, message="Cannot update status of a non-pending invoice")
+            if not ("items" in body and uses_item_collection(old)):
+                return format_response(409, message="Invoice changed during update, please retry")
 
-        return format_response(
-            200,
-            message="Invoice updated successfully",
-            data={"reference_id": reference_id, "updated_fields": list(body.keys())}
-        )
+            # Collection-layout invoices keep line items as separate rows: write
+            # the new set as a fresh generation, switch the header to it at the
+            # version we just saw, then drop the old generation. Readers follow
+            # the header, so they see either the old set or the new one.
+            generation = new_items_generation()
+            items = write_line_items(reference_id, body["items"], generation)
+            try:
+                invoice = conditional_update(
+                    reference_id, body, collection_version=invoice_version(old), items_generation=generation
+                )
+            except Exception as e:
+                delete_line_items(reference_id, prefix=line_item_prefix(generation))
+                if isinstance(e, DYNAMODB_CLIENT.exceptions.ConditionalCheckFailedException):
+                    return format_response(409, message="Invoice changed during update, please retry")
+                raise
+            delete_line_items(reference_id, prefix=line_item_prefix(old.get("items_generation")))
+            invoice["items"] = items
+
+        return _updated("Invoice updated successfully", with_int_version(with_attachment_url(decimal_to_float(invoice))))
 
     except Exception as e:
         print(f"Error updating invoice: {e}")
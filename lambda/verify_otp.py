@@ -1,5 +1,8 @@
 import json, time, hmac
-from common import format_response, OTP_TABLE, hash_otp, issue_tokens
+from common import (
+    format_response, OTP_TABLE, hash_otp, issue_tokens,
+    TransactionCanceledException, transaction_cancel_reasons
+)
 
 def lambda_handler(event, context):
     try:
@@ -31,9 +34,24 @@ def lambda_handler(event, context):
         if not hmac.compare_digest(expected, item["otp_hash"]):
             return format_response(400, message="Invalid OTP code", errors={"otp_code": "Incorrect"})
 
-        # ✅ OTP success — delete & issue tokens
-        OTP_TABLE.delete_item(Key={"email": email})
-        access_token, refresh_token, refresh_exp = issue_tokens(email)
+        # ✅ OTP success — consume OTP & store refresh token in one transaction.
+        # The delete is conditional on the hash we just verified, so a replayed
+        # (or concurrently used) OTP cancels the whole write and issues nothing.
+        consume_otp = {
+            "Delete": {
+                "TableName": OTP_TABLE.name,
+                "Key": {"email": email},
+                "ConditionExpression": "otp_hash = :h",
+                "ExpressionAttributeValues": {":h": item["otp_hash"]},
+            }
+        }
+        try:
+            access_token, refresh_token, refresh_exp = issue_tokens(email, transact_items=[consume_otp])
+        except TransactionCanceledException as e:
+            reasons = transaction_cancel_reasons(e)
+            if reasons and reasons[0] == "ConditionalCheckFailed":
+                return format_response(400, message="OTP already used", errors={"otp_code": "Invalid or expired"})
+            return format_response(409, message="Login conflict, please retry", errors={"transaction": reasons})
 
         headers = {
             "Content-Type": "application/json",
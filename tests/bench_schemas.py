@@ -0,0 +1,47 @@
+"""
+Micro-benchmark for the compiled request schemas: python tests/bench_schemas.py
+
+The "presence checks" row is the loop the schemas replaced. It only checks
+that keys exist, so it is a lower bound, not a like-for-like comparison:
+the schemas also check types, ranges, formats and money places.
+"""
+import os
+import sys
+import timeit
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda"))
+
+from common import validate_invoice  # noqa: E402
+
+ITEM = {"particulars": "Consulting Fee", "project_class": "Professional Services",
+        "account": "4000", "vatable": True, "amount": Decimal("5000.00")}
+INVOICE = {"company_name": "Blackpearl Company", "tin": "123-987-456", "invoice_number": "123498765",
+           "transaction_date": "2025-08-07", "items": [dict(ITEM) for _ in range(20)],
+           "payee": "payee@example.com", "payee_account": "1234567890", "approver": "approver@example.com"}
+BAD = {**INVOICE, "tin": "", "items": [{**ITEM, "amount": Decimal("1.001"), "vatable": "yes"}] * 20}
+
+
+def presence_checks(body):
+    # Required fields, then item fields, first error wins
+    for f in ["company_name", "tin", "invoice_number", "transaction_date", "items", "payee", "payee_account", "approver"]:
+        if f not in body:
+            return {"missing_fields": [f]}
+    for idx, it in enumerate(body["items"]):
+        missing = [f for f in ["particulars", "project_class", "account", "vatable", "amount"] if f not in it]
+        if missing:
+            return {f"item_{idx}": missing}
+    return {}
+
+
+def main(runs=20000):
+    for name, fn in (("schema (valid, 20 items)", lambda: validate_invoice(INVOICE)),
+                     ("schema (40 errors)", lambda: validate_invoice(BAD)),
+                     ("presence checks only", lambda: presence_checks(INVOICE))):
+        seconds = timeit.timeit(fn, number=runs)
+        print(f"{name:32s} {seconds / runs * 1e6:8.1f} us/call")
+    print(f"errors reported for the bad payload: {len(validate_invoice(BAD)[1])}")
+
+
+if __name__ == "__main__":
+    main()
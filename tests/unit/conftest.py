@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Handlers import each other as top-level modules (the Lambda code root)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "lambda"))
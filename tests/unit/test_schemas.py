@@ -0,0 +1,122 @@
+from decimal import Decimal
+
+import pytest
+
+from common import validate_field, validate_invoice, validate_invoice_update, validate_line_item
+
+
+def line_item(**overrides):
+    item = {"particulars": "Consulting Fee", "project_class": "Professional Services",
+            "account": "4000", "vatable": True, "amount": Decimal("5000.00")}
+    item.update(overrides)
+    return item
+
+
+def invoice(**overrides):
+    body = {"company_name": "Blackpearl Company", "tin": "123-987-456", "invoice_number": "123498765",
+            "transaction_date": "2025-08-07", "items": [line_item()],
+            "payee": "Payee@Example.com", "payee_account": "1234567890", "approver": "approver@example.com"}
+    body.update(overrides)
+    return body
+
+
+def test_valid_invoice_is_cleaned():
+    clean, errors = validate_invoice(invoice(company_name="  Blackpearl  ", invoice_number=123, extra="dropped"))
+
+    assert errors == {}
+    assert clean["company_name"] == "Blackpearl"
+    assert clean["invoice_number"] == "123"
+    assert clean["payee"] == "payee@example.com"
+    assert "extra" not in clean
+
+
+def test_non_object_body_is_rejected():
+    assert validate_invoice([]) == (None, {"body": "must be an object"})
+    assert validate_line_item("item") == (None, {"body": "must be an object"})
+
+
+def test_every_error_is_reported():
+    body = invoice(tin="12 34", transaction_date="2025-02-30", payee="nobody", items=[])
+    del body["approver"]
+
+    _, errors = validate_invoice(body)
+
+    assert errors == {
+        "tin": "has an invalid format",
+        "transaction_date": "is not a valid date",
+        "payee": "must be an email address",
+        "items": "must have at least 1 entries",
+        "approver": "is required",
+    }
+
+
+def test_item_errors_are_keyed_by_path():
+    _, errors = validate_invoice(invoice(items=[line_item(), "oops", line_item(vatable="yes", amount=Decimal("1.001"))]))
+
+    assert errors == {
+        "items[1]": "must be an object",
+        "items[2].vatable": "must be true or false",
+        "items[2].amount": "must have at most 2 decimal places",
+    }
+
+
+@pytest.mark.parametrize("amount, message", [
+    (1.5, "must be a number"),
+    ("ten", "must be a number"),
+    (Decimal("NaN"), "must be a finite number"),
+    ("Infinity", "must be a finite number"),
+    (Decimal("0"), "must be at least 0.01"),
+    (Decimal("1000000000000"), "must be at most 999999999999.99"),
+    ("12345678901234567890123456789.123", "must be at most 999999999999.99"),
+    (Decimal("1.005"), "must have at most 2 decimal places"),
+])
+def test_line_item_amount_errors(amount, message):
+    clean, errors = validate_line_item(line_item(amount=amount))
+
+    assert errors == {"amount": message}
+    assert clean["amount"] is None
+
+
+@pytest.mark.parametrize("amount, expected", [
+    ("12.50", Decimal("12.50")),
+    (7, Decimal("7")),
+    (Decimal("3.100"), Decimal("3.1")),
+])
+def test_line_item_amount_is_accepted(amount, expected):
+    clean, errors = validate_line_item(line_item(amount=amount))
+
+    assert errors == {}
+    assert clean["amount"] == expected
+
+
+def test_line_item_string_errors():
+    _, errors = validate_line_item(line_item(particulars="   ", project_class=["x"], account="a" * 101))
+
+    assert errors == {
+        "particulars": "must not be empty",
+        "project_class": "must be a string",
+        "account": "must be at most 100 characters",
+    }
+
+
+def test_update_schema_is_partial_and_checks_choices():
+    assert validate_invoice_update({}) == ({}, {})
+    _, errors = validate_invoice_update({"status": "Paid"})
+    assert errors == {"status": "must be one of ['Approved', 'Pending', 'Rejected']"}
+
+
+def test_validate_field_checks_one_field():
+    assert validate_field(validate_line_item, "amount", "2.25") == (Decimal("2.25"), {})
+    assert validate_field(validate_line_item, "amount", "2.255") == (None, {"amount": "must have at most 2 decimal places"})
+    assert validate_field(validate_invoice_update, "tin", "") == ("", {"tin": "must not be empty"})
+
+
+def test_validate_field_prefixes_nested_errors():
+    _, errors = validate_field(validate_invoice_update, "items", [line_item(amount="x")])
+
+    assert errors == {"items[0].amount": "must be a number"}
+
+
+def test_validate_field_unknown_field_raises():
+    with pytest.raises(KeyError):
+        validate_field(validate_line_item, "colour", "red")
@@ -0,0 +1,166 @@
+from decimal import Decimal
+
+import pytest
+
+from update_invoice import PatchError, build_patch_update
+
+
+def conditions_of(kwargs):
+    return kwargs["ConditionExpression"].split(" AND ")
+
+
+def test_add_item_field_requires_the_item_not_the_field():
+    kwargs, touches_items, _ = build_patch_update([{"op": "add", "path": "/items/2/remarks", "value": "rush"}])
+
+    assert touches_items
+    assert "SET #items[2].#remarks = :v0" in kwargs["UpdateExpression"]
+    conditions = conditions_of(kwargs)
+    assert "attribute_exists(#items[2])" in conditions
+    assert "attribute_exists(#items[2].#remarks)" not in conditions
+    assert "attribute_not_exists(items_layout)" in conditions
+
+
+def test_add_top_level_field_has_no_existence_check():
+    kwargs, touches_items, _ = build_patch_update([{"op": "add", "path": "/company_name", "value": "Acme"}])
+
+    assert not touches_items
+    assert kwargs["ConditionExpression"] == "attribute_exists(reference_id)"
+    assert kwargs["ExpressionAttributeValues"][":v0"] == "Acme"
+
+
+def test_add_append_item_uses_list_append():
+    item = {"particulars": "Paper", "project_class": "ops", "account": "supplies", "vatable": True, "amount": Decimal("12.50")}
+    kwargs, touches_items, _ = build_patch_update([{"op": "add", "path": "/items/-", "value": item}])
+
+    assert touches_items
+    assert "#items = list_append(if_not_exists(#items, :v0), :v1)" in kwargs["UpdateExpression"]
+    assert kwargs["ExpressionAttributeValues"][":v1"][0]["amount"] == Decimal("12.50")
+
+
+def test_add_whole_item_at_index_is_rejected():
+    with pytest.raises(PatchError, match="only be inserted at the end"):
+        build_patch_update([{"op": "add", "path": "/items/0", "value": {}}])
+
+
+def test_replace_item_field_requires_the_field():
+    kwargs, _, _ = build_patch_update([{"op": "replace", "path": "/items/0/amount", "value": 5}])
+
+    assert "attribute_exists(#items[0].#amount)" in conditions_of(kwargs)
+    assert kwargs["ExpressionAttributeValues"][":v0"] == Decimal("5.00")
+
+
+def test_replace_top_level_field_requires_it():
+    kwargs, _, _ = build_patch_update([{"op": "replace", "path": "/tin", "value": "123-456"}])
+
+    assert "attribute_exists(#tin)" in conditions_of(kwargs)
+
+
+def test_replace_status_checks_pending():
+    kwargs, _, touches_status = build_patch_update([{"op": "replace", "path": "/status", "value": "Approved"}])
+
+    assert touches_status
+    assert "#status = :v1" in conditions_of(kwargs)
+    assert kwargs["ExpressionAttributeValues"][":v1"] == "Pending"
+
+
+def test_remove_optional_item_field_requires_it():
+    kwargs, _, _ = build_patch_update([{"op": "remove", "path": "/items/1/remarks"}])
+
+    assert "REMOVE #items[1].#remarks" in kwargs["UpdateExpression"]
+    assert "attribute_exists(#items[1].#remarks)" in conditions_of(kwargs)
+
+
+def test_remove_required_fields_is_rejected():
+    with pytest.raises(PatchError, match="required"):
+        build_patch_update([{"op": "remove", "path": "/items/1/amount"}])
+    with pytest.raises(PatchError, match="required"):
+        build_patch_update([{"op": "remove", "path": "/company_name"}])
+
+
+def test_test_op_becomes_a_condition():
+    kwargs, touches_items, _ = build_patch_update([
+        {"op": "test", "path": "/items/0/amount", "value": Decimal("10.00")},
+        {"op": "replace", "path": "/company_name", "value": "Acme"},
+    ])
+
+    assert touches_items
+    conditions = conditions_of(kwargs)
+    assert "#items[0].#amount = :v0" in conditions
+    assert "attribute_not_exists(items_layout)" in conditions
+
+
+def test_test_only_patch_is_rejected():
+    with pytest.raises(PatchError, match="no add/replace/remove"):
+        build_patch_update([{"op": "test", "path": "/tin", "value": "1"}])
+
+
+def test_overlapping_ops_are_rejected():
+    with pytest.raises(PatchError, match="overlaps"):
+        build_patch_update([
+            {"op": "replace", "path": "/items/0/remarks", "value": "a"},
+            {"op": "remove", "path": "/items/0/remarks"},
+        ])
+
+
+def test_invalid_value_is_reported_with_its_op():
+    with pytest.raises(PatchError, match="Operation 0: amount"):
+        build_patch_update([{"op": "replace", "path": "/items/0/amount", "value": "lots"}])
+
+
+def test_expected_version_is_part_of_the_condition():
+    kwargs, _, _ = build_patch_update([{"op": "replace", "path": "/tin", "value": "1"}], expected_version=3)
+
+    assert "ADD #version" in kwargs["UpdateExpression"]
+    assert len(conditions_of(kwargs)) == 3
+
+
+def test_appended_item_gets_an_id():
+    item = {"particulars": "Paper", "project_class": "ops", "account": "supplies", "vatable": True, "amount": Decimal("1.00")}
+    kwargs, _, _ = build_patch_update([{"op": "add", "path": "/items/-", "value": item}])
+
+    assert kwargs["ExpressionAttributeValues"][":v1"][0]["id"]
+
+
+def test_later_indices_follow_earlier_removes():
+    kwargs, _, _ = build_patch_update([
+        {"op": "remove", "path": "/items/3"},
+        {"op": "remove", "path": "/items/4"},
+    ])
+
+    assert "REMOVE #items[3], #items[5]" in kwargs["UpdateExpression"]
+    conditions = conditions_of(kwargs)
+    assert "attribute_exists(#items[3])" in conditions
+    assert "attribute_exists(#items[5])" in conditions
+
+
+def test_replace_after_remove_targets_the_shifted_item():
+    kwargs, _, _ = build_patch_update([
+        {"op": "remove", "path": "/items/0"},
+        {"op": "replace", "path": "/items/1/amount", "value": "2.00"},
+        {"op": "test", "path": "/items/0/account", "value": "4000"},
+    ])
+
+    assert "SET #items[2].#amount = :v0" in kwargs["UpdateExpression"]
+    assert "REMOVE #items[0]" in kwargs["UpdateExpression"]
+    conditions = conditions_of(kwargs)
+    assert "attribute_exists(#items[2].#amount)" in conditions
+    assert "#items[1].#account = :v1" in conditions
+
+
+def test_repeated_remove_of_the_same_index_removes_consecutive_items():
+    kwargs, _, _ = build_patch_update([
+        {"op": "remove", "path": "/items/1"},
+        {"op": "remove", "path": "/items/1"},
+        {"op": "remove", "path": "/items/0"},
+    ])
+
+    assert "REMOVE #items[1], #items[2], #items[0]" in kwargs["UpdateExpression"]
+
+
+def test_earlier_indices_are_not_shifted():
+    kwargs, _, _ = build_patch_update([
+        {"op": "remove", "path": "/items/2"},
+        {"op": "replace", "path": "/items/1/remarks", "value": "x"},
+    ])
+
+    assert "SET #items[1].#remarks = :v0" in kwargs["UpdateExpression"]